@@ -3,6 +3,7 @@ from anndata import AnnData
 import anndata
 import scipy.sparse as sp
 import time
+import os
 from sklearn.preprocessing import Normalizer, StandardScaler
 import pickle
 import pandas as pd
@@ -58,6 +59,10 @@ class SAM(object):
     adata: AnnData
         An AnnData object containing all processed data and SAM outputs.
 
+    knn_index: utilities.NNIndex
+        The nearest-neighbor index of the cells in the final PC space, if
+        one was built (see 'get_knn_index').
+
     """
 
     def __init__(self, counts=None):
@@ -107,12 +112,14 @@ class SAM(object):
 
         self.run_args = {}
         self.preprocess_args = {}
+        self.knn_index = None
 
     def preprocess_data(self, div=1, downsample=0, sum_norm=None,
                         include_genes=None, exclude_genes=None,
                         include_cells=None, exclude_cells=None,
                         norm='log', min_expression=1, thresh=0.01,
-                        filter_genes=True):
+                        filter_genes=True, clip_residuals=None,
+                        dense_residuals=False, chunk_size=10000):
         """Log-normalizes and filters the expression data.
 
         Parameters
@@ -176,6 +183,23 @@ class SAM(object):
             in exclude_genes or not passed in include_genes will still be
             filtered.
 
+        clip_residuals : float or str, optional, default None
+            If norm='multinomial', the Pearson residuals are clipped to
+            [-clip_residuals, clip_residuals]. If 'auto', they are clipped to
+            the square root of the number of cells. If None, residuals are
+            not clipped.
+
+        dense_residuals : bool, optional, default False
+            If norm='multinomial', only the residuals of the nonzero counts
+            are stored in .adata.X. If True, 'run'
+            computes the full (dense) residuals, including those of the zero
+            values, for the top SAM genes used in PCA.
+
+        chunk_size : int, optional, default 10000
+            If the raw data was loaded in backed mode (see 'load_data'), the
+            number of cells read from disk and normalized at a time. Only the
+            filtered, normalized matrix is held in memory.
+
         """
 
         self.preprocess_args = {
@@ -187,13 +211,16 @@ class SAM(object):
                 'norm':norm,
                 'min_expression':min_expression,
                 'thresh':thresh,
-                'filter_genes':filter_genes
+                'filter_genes':filter_genes,
+                'clip_residuals':clip_residuals,
+                'dense_residuals':dense_residuals
                 }
 
         # load data
         try:
             D= self.adata_raw.X
-            self.adata = self.adata_raw.copy()
+            if not self.adata_raw.isbacked:
+                self.adata = self.adata_raw.copy()
 
         except AttributeError:
             print('No data loaded')
@@ -203,12 +230,12 @@ class SAM(object):
         idx_cells = np.arange(D.shape[0])
         if(include_cells is not None):
             include_cells = np.array(list(include_cells))
-            idx2 = np.where(np.in1d(cell_names, include_cells))[0]
+            idx2 = np.where(np.isin(cell_names, include_cells))[0]
             idx_cells = np.array(list(set(idx2) & set(idx_cells)))
 
         if(exclude_cells is not None):
             exclude_cells = np.array(list(exclude_cells))
-            idx4 = np.where(np.in1d(cell_names, exclude_cells,
+            idx4 = np.where(np.isin(cell_names, exclude_cells,
                                     invert=True))[0]
             idx_cells = np.array(list(set(idx4) & set(idx_cells)))
 
@@ -223,6 +250,15 @@ class SAM(object):
         mask_cells = np.zeros(D.shape[0], dtype='bool')
         mask_cells[idx_cells] = True
 
+        if self.adata_raw.isbacked:
+            self.preprocess_backed_data(
+                mask_cells, div=div, sum_norm=sum_norm,
+                include_genes=include_genes, exclude_genes=exclude_genes,
+                norm=norm, min_expression=min_expression, thresh=thresh,
+                filter_genes=filter_genes, clip_residuals=clip_residuals,
+                chunk_size=chunk_size)
+            return
+
         if mask_cells.sum() < mask_cells.size:
             self.adata = self.adata_raw[mask_cells,:].copy()
 
@@ -237,106 +273,177 @@ class SAM(object):
         if(D.getformat() == 'csc'):
             D=D.tocsr();
 
-        # sum-normalize
-        if (sum_norm == 'cell_median' and norm != 'multinomial'):
-            s = D.sum(1).A.flatten()
-            sum_norm = np.median(s)
-            D = D.multiply(1 / s[:,None] * sum_norm).tocsr()
-        elif (sum_norm == 'gene_median' and norm != 'multinomial'):
-            s = D.sum(0).A.flatten()
-            sum_norm = np.median(s[s>0])
-            s[s==0]=1
-            D = D.multiply(1 / s[None,:] * sum_norm).tocsr()
-
-        elif sum_norm is not None and norm != 'multinomial':
-            D = D.multiply(1 / D.sum(1).A.flatten()[:,
-                    None] * sum_norm).tocsr()
-
-        # normalize
-        self.adata.X = D
-        if norm is None:
-            D.data[:] = (D.data / div)
-
-        elif(norm.lower() == 'log'):
-            D.data[:] = np.log2(D.data / div + 1)
-
-        elif(norm.lower() == 'ftt'):
-            D.data[:] = np.sqrt(D.data/div) + np.sqrt(D.data/div+1) - 1
-
-        elif(norm.lower() == 'asin'):
-            D.data[:] = np.arcsinh(D.data/div)
-        elif norm.lower() == 'multinomial':
-            ni = D.sum(1).A.flatten() #cells
-            pj = (D.sum(0) / D.sum()).A.flatten() #genes
-            col = D.indices
-            row=[]
-            for i in range(D.shape[0]):
-                row.append(i*np.ones(D.indptr[i+1]-D.indptr[i]))
-            row = np.concatenate(row).astype('int32')
-            mu = sp.coo_matrix((ni[row]*pj[col], (row,col))).tocsr()
-            mu2 = mu.copy()
-            mu2.data[:]=mu2.data**2
-            mu2 = mu2.multiply(1/ni[:,None])
-            mu.data[:] = (D.data - mu.data) / np.sqrt(mu.data - mu2.data)
-
-            self.adata.X = mu
-            if sum_norm is None:
+        # sum-normalization factors
+        row_scale = None
+        col_scale = None
+        with np.errstate(divide='ignore'):
+            if (sum_norm == 'cell_median' and norm != 'multinomial'):
+                s = np.asarray(D.sum(1, dtype='float64')).flatten()
+                sum_norm = np.median(s)
+                row_scale = sum_norm / s
+            elif (sum_norm == 'gene_median' and norm != 'multinomial'):
+                s = np.asarray(D.sum(0, dtype='float64')).flatten()
+                sum_norm = np.median(s[s>0])
+                s[s==0]=1
+                col_scale = sum_norm / s
+                self.adata.var['gene_sums'] = s
+
+            elif sum_norm is not None and norm != 'multinomial':
+                row_scale = sum_norm / np.asarray(
+                    D.sum(1, dtype='float64')).flatten()
+
+        if norm is not None and norm.lower() == 'multinomial':
+            if clip_residuals == 'auto':
+                clip_residuals = np.sqrt(D.shape[0])
+            mu, ni, pj = ut.pearson_residuals(D, clip=clip_residuals)
+            self.adata.obs['total_counts'] = ni
+            self.adata.var['gene_fraction'] = pj
+
+            if sum_norm is None or isinstance(sum_norm, str):
                 sum_norm = np.median(ni)
-            D = D.multiply(1 / ni[:,None] * sum_norm).tocsr()
-            D.data[:] = np.log2(D.data / div + 1)
+            with np.errstate(divide='ignore'):
+                row_scale = sum_norm / ni
 
-        else:
-            D.data[:] = (D.data / div)
-
-        # zero-out low-expressed genes
-        idx = np.where(D.data <= min_expression)[0]
-        D.data[idx] = 0
+        # normalize, zero-out low-expressed genes, and count the number of
+        # cells expressing each gene in a single pass
+        D, c = ut.normalize_sparse(
+            D, row_scale=row_scale, col_scale=col_scale,
+            norm='log' if norm == 'multinomial' else norm, div=div,
+            min_expression=min_expression)
 
         # filter genes
         gene_names = np.array(list(self.adata.var_names))
-        idx_genes = np.arange(D.shape[1])
+        mask_genes = np.ones(D.shape[1], dtype='bool')
         if(include_genes is not None):
-            include_genes = np.array(list(include_genes))
-            idx = np.where(np.in1d(gene_names, include_genes))[0]
-            idx_genes = np.array(list(set(idx) & set(idx_genes)))
+            mask_genes &= np.isin(gene_names, np.array(list(include_genes)))
 
         if(exclude_genes is not None):
-            exclude_genes = np.array(list(exclude_genes))
-            idx3 = np.where(np.in1d(gene_names, exclude_genes,
-                                    invert=True))[0]
-            idx_genes = np.array(list(set(idx3) & set(idx_genes)))
+            mask_genes &= np.isin(gene_names, np.array(list(exclude_genes)),
+                                  invert=True)
 
         if(filter_genes):
-            a, ct = np.unique(D.indices, return_counts=True)
-            c = np.zeros(D.shape[1])
-            c[a] = ct
-
-            keep = np.where(np.logical_and(c / D.shape[0] > thresh,
-                                           c / D.shape[0] <= 1 - thresh))[0]
-
-            idx_genes = np.array(list(set(keep) & set(idx_genes)))
-
+            mask_genes &= np.logical_and(c / D.shape[0] > thresh,
+                                         c / D.shape[0] <= 1 - thresh)
 
-        mask_genes = np.zeros(D.shape[1], dtype='bool')
-        mask_genes[idx_genes] = True
-
-        self.adata.X = self.adata.X.multiply(mask_genes[None, :]).tocsr()
-        self.adata.X.eliminate_zeros()
         self.adata.var['mask_genes']=mask_genes
 
         if norm == 'multinomial':
-            self.adata.layers['X_disp'] = D.multiply(mask_genes[None, :]).tocsr()
-            self.adata.layers['X_disp'].eliminate_zeros()
+            self.adata.X = ut.filter_sparse(mu, mask_genes, keep_zeros=True)
+            self.adata.layers['X_disp'] = ut.filter_sparse(D, mask_genes)
         else:
+            self.adata.X = ut.filter_sparse(D, mask_genes)
             self.adata.layers['X_disp'] = self.adata.X
+        self.adata.uns['sum_norm'] = sum_norm
+        self.adata.uns['preprocess_args'] = self.preprocess_args
+
+    def preprocess_backed_data(self, mask_cells, div=1, sum_norm=None,
+                               include_genes=None, exclude_genes=None,
+                               norm='log', min_expression=1, thresh=0.01,
+                               filter_genes=True, clip_residuals=None,
+                               chunk_size=10000):
+        """Out-of-core counterpart of 'preprocess_data' for raw data loaded in
+        backed mode. The cells selected by 'mask_cells' are streamed from
+        disk in chunks of 'chunk_size' rows twice: once to gather per-cell
+        and per-gene totals and per-gene expression counts, and once to
+        normalize, threshold, and filter the data. Only the filtered,
+        normalized matrix is held in memory. See 'preprocess_data' for the
+        remaining parameters.
+        """
+        X = self.adata_raw.X
+        numcells = mask_cells.sum()
+
+        # first pass: totals and expression counts
+        cell_sums = np.zeros(numcells)
+        gene_sums = np.zeros(X.shape[1])
+        c = np.zeros(X.shape[1])
+        i = 0
+        for D in ut.iter_row_chunks(X, chunk_size, mask_cells):
+            cell_sums[i:i + D.shape[0]] = np.asarray(
+                D.sum(1, dtype='float64')).flatten()
+            gene_sums += np.asarray(D.sum(0, dtype='float64')).flatten()
+            c += np.bincount(D.indices, minlength=X.shape[1])
+            i += D.shape[0]
+
+        multinomial = norm is not None and norm.lower() == 'multinomial'
+        if multinomial:
+            pj = gene_sums / gene_sums.sum()
+            if clip_residuals == 'auto':
+                clip_residuals = np.sqrt(numcells)
+            if sum_norm is None or isinstance(sum_norm, str):
+                sum_norm = np.median(cell_sums)
+        elif sum_norm == 'cell_median':
+            sum_norm = np.median(cell_sums)
+        elif sum_norm == 'gene_median':
+            sum_norm = np.median(gene_sums[gene_sums > 0])
+            gene_sums[gene_sums == 0] = 1
+
+        # filter genes
+        gene_names = np.array(list(self.adata_raw.var_names))
+        mask_genes = np.ones(X.shape[1], dtype='bool')
+        if(include_genes is not None):
+            mask_genes &= np.isin(gene_names, np.array(list(include_genes)))
+        if(exclude_genes is not None):
+            mask_genes &= np.isin(gene_names, np.array(list(exclude_genes)),
+                                  invert=True)
+        if(filter_genes):
+            mask_genes &= np.logical_and(c / numcells > thresh,
+                                         c / numcells <= 1 - thresh)
+
+        # second pass: normalize, threshold, and filter
+        chunks = []
+        residuals = []
+        i = 0
+        for D in ut.iter_row_chunks(X, chunk_size, mask_cells):
+            row_scale = None
+            col_scale = None
+            ni = cell_sums[i:i + D.shape[0]]
+            if multinomial:
+                R = ut.pearson_residuals(D, ni=ni, pj=pj,
+                                         clip=clip_residuals)[0]
+                residuals.append(ut.filter_sparse(R, mask_genes,
+                                                  keep_zeros=True))
+            if sum_norm is not None:
+                if (self.preprocess_args['sum_norm'] == 'gene_median' and
+                        not multinomial):
+                    col_scale = sum_norm / gene_sums
+                else:
+                    with np.errstate(divide='ignore'):
+                        row_scale = sum_norm / ni
+            i += D.shape[0]
+
+            D = ut.normalize_sparse(D, row_scale=row_scale,
+                                    col_scale=col_scale,
+                                    norm='log' if multinomial else norm,
+                                    div=div,
+                                    min_expression=min_expression)[0]
+            chunks.append(ut.filter_sparse(D, mask_genes))
+
+        D = sp.vstack(chunks, format='csr')
+        del chunks
+
+        self.adata = AnnData(X=D,
+                             obs=self.adata_raw.obs[mask_cells].copy(),
+                             var=self.adata_raw.var.copy())
+        self.adata.var['mask_genes'] = mask_genes
+        self.adata.layers['X_disp'] = self.adata.X
+        if multinomial:
+            self.adata.X = sp.vstack(residuals, format='csr')
+            self.adata.obs['total_counts'] = cell_sums
+            self.adata.var['gene_fraction'] = pj
+        elif self.preprocess_args['sum_norm'] == 'gene_median':
+            self.adata.var['gene_sums'] = gene_sums
+        self.adata.uns['sum_norm'] = sum_norm
         self.adata.uns['preprocess_args'] = self.preprocess_args
 
     def load_data(self, filename, transpose=True,
-                  save_sparse_file=None, sep=',', **kwargs):
+                  save_sparse_file=None, sep=',', backed=False, **kwargs):
         """Loads the specified data file. The file can be a table of
         read counts (i.e. '.csv' or '.txt'), with genes as rows and cells
         as columns by default. The file can also be a pickle file (output from
-        'save_sparse_data') or an h5ad file (output from 'save_anndata').
+        'save_sparse_data'), an h5ad file (output from 'save_anndata'), or a
+        Matrix Market file ('.mtx' or '.mtx.gz'). A directory containing
+        'matrix.mtx', 'barcodes.tsv', and 'features.tsv' (or 'genes.tsv'),
+        optionally gzipped, as written by 10x Cell Ranger is also accepted.
 
         This function that loads the file specified by 'filename'.
 
@@ -360,8 +467,18 @@ class SAM(object):
             By default, assumes file is (genes x cells). Set this to False if
             the file has dimensions (cells x genes).
 
+        backed - bool, optional, default False
+            If True, opens an h5ad file in read-only backed mode instead of
+            loading it into memory. 'preprocess_data' then streams the raw
+            data from disk in chunks, so only the filtered, normalized data is
+            held in memory. Raw data stored in CSR format (cells x genes) is
+            read most efficiently.
+
 
         """
+        if backed and filename.split('.')[-1] != 'h5ad':
+            raise ValueError("Backed mode requires an h5ad file.")
+
         if filename.split('.')[-1] == 'p':
             raw_data, all_cell_names, all_gene_names = (
                 pickle.load(open(filename, 'rb')))
@@ -373,16 +490,15 @@ class SAM(object):
                     raw_data=raw_data.tocsr()
 
             save_sparse_file = None
-        elif filename.split('.')[-1] != 'h5ad':
-            df = pd.read_csv(filename, sep=sep, index_col=0, **kwargs)
-            if(transpose):
-                dataset = df.T
-            else:
-                dataset = df
+        elif (os.path.isdir(filename) or
+                filename.split('.')[-1] == 'mtx' or
+                filename.split('.')[-2:] == ['mtx', 'gz']):
+            raw_data, all_cell_names, all_gene_names = ut.read_mtx(
+                filename, transpose=transpose)
 
-            raw_data = sp.csr_matrix(dataset.values)
-            all_cell_names = np.array(list(dataset.index.values))
-            all_gene_names = np.array(list(dataset.columns.values))
+        elif filename.split('.')[-1] != 'h5ad':
+            raw_data, all_cell_names, all_gene_names = ut.read_sparse_table(
+                filename, sep=sep, transpose=transpose, **kwargs)
 
         if filename.split('.')[-1] != 'h5ad':
             self.adata_raw = AnnData(X=raw_data, obs={'obs_names': all_cell_names},
@@ -396,6 +512,11 @@ class SAM(object):
             self.adata = self.adata_raw.copy()
             self.adata.layers['X_disp'] = raw_data
 
+        elif backed:
+            self.adata_raw = anndata.read_h5ad(filename, backed='r', **kwargs)
+            self.adata = self.adata_raw
+            save_sparse_file = None
+
         else:
             self.adata_raw = anndata.read_h5ad(filename, **kwargs)
             self.adata = self.adata_raw.copy()
@@ -554,7 +675,7 @@ class SAM(object):
 
                 if isinstance(c, str):
                     try:
-                        c = self.adata.obs[c].get_values()
+                        c = self.adata.obs[c].to_numpy()
                     except KeyError:
                         0  # do nothing
 
@@ -607,7 +728,7 @@ class SAM(object):
         all_gene_names = np.array(list(self.adata.var_names))
         cell_names = np.array(list(self.adata.obs_names))
         all_cell_names = np.array(list(self.adata_raw.obs_names))
-        idx2 = np.where(np.in1d(all_cell_names,cell_names))[0]
+        idx2 = np.where(np.isin(all_cell_names,cell_names))[0]
         idx = np.where(all_gene_names == gene)[0]
         name = gene
         if(idx.size == 0):
@@ -617,7 +738,12 @@ class SAM(object):
             return
 
         if(avg):
-            a = self.adata.layers['X_knn_avg'][:, idx].toarray().flatten()
+            if 'X_knn_avg' in self.adata.layers.keys():
+                a = self.adata.layers['X_knn_avg'][:, idx].toarray().flatten()
+            else:
+                a = ut.knn_avg(self.adata.uns['neighbors']['connectivities'],
+                               self.adata.layers['X_disp'][:, idx]
+                               ).toarray().flatten()
             if a.sum() == 0:
                 a = self.adata_raw.X[:,idx].toarray().flatten()[idx2]
                 try:
@@ -653,7 +779,8 @@ class SAM(object):
 
         return axes, a
 
-    def dispersion_ranking_NN(self, nnm = None, num_norm_avg=50):
+    def dispersion_ranking_NN(self, nnm = None, num_norm_avg=50,
+                              save_avg=True):
         """Computes the spatial dispersion factors for each gene.
 
         Parameters
@@ -668,6 +795,14 @@ class SAM(object):
             that outlier genes do not significantly skew the weight
             distribution.
 
+        save_avg - bool, optional, default True
+            If True, the kNN-averaged expression matrix is stored in
+            .adata.layers['X_knn_avg'], overwriting the buffers of the
+            previous layer where possible (take a copy of the layer to keep
+            it). Otherwise, the per-gene means and variances are accumulated
+            over chunks of cells and the averaged matrix is never held in
+            memory.
+
         Returns:
         -------
         weights - ndarray, float
@@ -676,25 +811,26 @@ class SAM(object):
         if (nnm is None):
             nnm = self.adata.uns['neighbors']['connectivities']
 
-        D_avg = (nnm.multiply(1/nnm.sum(1).A)).dot(self.adata.layers['X_disp'])
+        if save_avg:
+            # the previous layer is handed over to be overwritten
+            D_avg = ut.knn_avg(nnm, self.adata.layers['X_disp'],
+                               out=self.adata.layers.pop('X_knn_avg', None))
 
-        self.adata.layers['X_knn_avg'] = D_avg
+            self.adata.layers['X_knn_avg'] = D_avg
 
-        if sp.issparse(D_avg):
-              mu, var = sf.mean_variance_axis(D_avg, axis=0)
+            if sp.issparse(D_avg):
+                  mu, var = sf.mean_variance_axis(D_avg, axis=0)
+            else:
+                  mu=D_avg.mean(0)
+                  var=D_avg.var(0)
         else:
-              mu=D_avg.mean(0)
-              var=D_avg.var(0)
+            mu, var = ut.knn_avg_moments(nnm, self.adata.layers['X_disp'])
+            if 'X_knn_avg' in self.adata.layers.keys():
+                del self.adata.layers['X_knn_avg']
 
-        dispersions = np.zeros(var.size)
-        dispersions[mu > 0] = var[mu > 0] / mu[mu > 0]
+        weights, dispersions = ut.dispersion_weights(mu, var, num_norm_avg)
 
-        self.adata.var['spatial_dispersions'] = dispersions.copy()
-
-        ma = np.sort(dispersions)[-num_norm_avg:].mean()
-        dispersions[dispersions >= ma] = ma
-
-        weights = ((dispersions / dispersions.max())**0.5).flatten()
+        self.adata.var['spatial_dispersions'] = dispersions
 
         self.adata.var['weights'] = weights
 
@@ -745,7 +881,7 @@ class SAM(object):
 
         gene_names = np.array(list(self.adata.var_names))
         if(genes is not None):
-            idx = np.where(np.in1d(gene_names, genes))[0]
+            idx = np.where(np.isin(gene_names, genes))[0]
             sx = pca.components_[:, idx]
             x = np.abs(sx).mean(1)
             return x
@@ -788,6 +924,15 @@ class SAM(object):
             npcs=None,
             n_genes=None,
             weight_PCs = True,
+            pca_solver='dense',
+            incremental_knn=False,
+            knn_method='auto',
+            store_knn_avg='always',
+            dtype='float64',
+            low_memory=False,
+            checkpoint=None,
+            resume_from=None,
+            schedule=None,
             proj_kwargs={}):
         """Runs the Self-Assembling Manifold algorithm.
 
@@ -831,11 +976,115 @@ class SAM(object):
             genes with large spatial dispersions from skewing the distribution
             of weights.
 
+        pca_solver - str, optional, default 'dense'
+            If 'dense', the selected genes are densified and decomposed with
+            sklearn's PCA. If 'sparse', the expression data is kept sparse and
+            the mean-centering is applied implicitly within a randomized SVD,
+            which avoids allocating a dense (cells x genes) array every
+            iteration. Note that 'StandardScaler' does not clip values in
+            sparse mode. If 'iterative', the sparse randomized SVD in each
+            iteration is seeded with the principal axes from the previous
+            iteration and stops its power iterations early once the subspace
+            has converged.
+
+        incremental_knn - bool, optional, default False
+            If True and an approximate kNN method is used, the previous
+            iteration's neighbors are reused as the initial graph for a short
+            NN-descent refinement instead of building a new graph every
+            iteration. The fraction of edges that changed in the last
+            iteration is stored in .adata.uns['knn_graph_change'].
+
+        knn_method - str, optional, default 'auto'
+            The nearest-neighbor backend: 'exact' (blocked brute-force
+            search), 'sharded' (exact search split over a pool of worker
+            processes, for very large datasets), 'nndescent' (NN-descent
+            with pynndescent), or 'hnsw' (an HNSW graph with hnswlib). If
+            'auto', exact search is used for small datasets (about 11500
+            cells at 150 PCs) and an approximate backend otherwise (see
+            utilities.choose_knn_method), raising an ImportError if neither
+            pynndescent nor hnswlib is installed. For approximate backends,
+            the recall of the final graph against exact neighbors of 1000
+            random cells is stored in .adata.uns['knn_recall'].
+
+        store_knn_avg - str, optional, default 'always'
+            If 'always', the kNN-averaged expression matrix is stored in
+            .adata.layers['X_knn_avg'] every iteration. If 'final', the gene
+            dispersions are computed in a streaming fashion during the
+            iterations and the averaged matrix is only stored after the last
+            iteration. If 'never', it is not stored at all (it is computed on
+            demand by 'get_knn_avg').
+
+        dtype - str, optional, default 'float64'
+            The floating point precision used within the SAM iterations. If
+            'float32', the expression data, PCA, nearest-neighbor distances,
+            kNN-averaged expression, and the stored outputs ('X_pca',
+            'X_processed', 'X_knn_avg', 'pca_obj') are all kept in single
+            precision, roughly halving memory usage. The gene weights remain
+            float64. On the example dataset the RMSE between float32 and
+            float64 gene weights is below 1e-3, i.e. well within the default
+            'stopping_condition'.
+
+        low_memory - bool, optional, default False
+            If True, the normalized and weighted expression data that is the
+            input to PCA is not kept in .adata.uns['X_processed']. Only the
+            PCA outputs (scores in .adata.obsm['X_pca'] and the fitted PCA in
+            .adata.uns['pca_obj']), the indices of the genes used
+            ('pca_gene_indices'), and their weights ('pca_gene_weights') are
+            stored. Methods that need the processed data rebuild it on demand
+            with 'get_X_processed'.
+
+        checkpoint - str, optional, default None
+            Path to a checkpoint file that is (atomically) rewritten after
+            every full-resolution iteration with the iteration number, gene
+            weights, nearest neighbor graph, convergence error, position in
+            the schedule, the indices and weights of the genes used for PCA,
+            and the random number generator state.
+
+        resume_from - str, optional, default None
+            Path to a checkpoint file written with 'checkpoint'. If provided,
+            the iterations continue from the saved state instead of starting
+            from a random nearest neighbor graph, yielding the same result
+            as the uninterrupted run. If the checkpointed run had converged,
+            its gene weights and graph are restored without further
+            iterations and its PCA is recomputed from the stored genes and
+            weights. With the 'iterative' PCA solver, the PCA that seeds the
+            next iteration is recomputed the same way, so resumed runs agree
+            with uninterrupted ones to the solver tolerance. The data and run
+            arguments should be the same as those of the interrupted run.
+
+        schedule - str, optional, default None
+            If 'coarse_to_fine', early iterations, which only need rough gene
+            weights, are computed on a random subset of 25% of the cells with
+            25% of 'npcs' and 'n_genes'. The resolution doubles once the
+            RMSE between gene weights drops below 0.1 or stops halving, and
+            jumps to the full size once it drops below 0.03. SAM
+            only stops after at least two full-size iterations, and
+            'max_iter' counts full-size iterations. If None, every iteration
+            runs at full size. Checkpoints are only saved for full-size
+            iterations. The size, error, and duration of each iteration are
+            stored in .adata.uns['run_log'].
+
         proj_kwargs - dict, optional, default {}
             A dictionary of keyword arguments to pass to the projection
             functions.
         """
+        if pca_solver not in ('dense', 'sparse', 'iterative'):
+            raise ValueError(
+                "'pca_solver' must be 'dense', 'sparse', or 'iterative'.")
+        if schedule not in (None, 'coarse_to_fine'):
+            raise ValueError("'schedule' must be None or 'coarse_to_fine'.")
+        if store_knn_avg not in ('always', 'final', 'never'):
+            raise ValueError(
+                "'store_knn_avg' must be 'always', 'final', or 'never'.")
+
         D = self.adata.X
+        if dtype == 'float32':
+            if D.dtype != dtype:
+                D = D.astype(dtype)
+            if self.adata.layers['X_disp'].dtype != dtype:
+                self.adata.layers['X_disp'] = self.adata.layers[
+                    'X_disp'].astype(dtype)
+
         if(k < 5):
             k = 5
         if(k > D.shape[0] - 1):
@@ -853,6 +1102,13 @@ class SAM(object):
                 'npcs':npcs,
                 'n_genes':n_genes,
                 'weight_PCs':weight_PCs,
+                'pca_solver':pca_solver,
+                'incremental_knn':incremental_knn,
+                'knn_method':knn_method,
+                'store_knn_avg':store_knn_avg,
+                'dtype':dtype,
+                'low_memory':low_memory,
+                'schedule':schedule,
                 'proj_kwargs':proj_kwargs,
                 }
 
@@ -882,46 +1138,137 @@ class SAM(object):
 
         tinit = time.time()
 
-        edm = sp.coo_matrix((numcells, numcells), dtype='i').tolil()
-        nums = np.arange(edm.shape[1])
-        RINDS = np.random.randint(
-            0, numcells, (k - 1) * numcells).reshape((numcells,(k - 1)))
-        RINDS = np.hstack((nums[:, None], RINDS))
+        self.adata.uns.pop('pca_obj', None)
 
-        edm[np.tile(np.arange(RINDS.shape[0])[:, None],
-                    (1, RINDS.shape[1])).flatten(), RINDS.flatten()] = 1
-        edm = edm.tocsr()
+        state = {}
+        wPCA_data = None
+        if resume_from is not None:
+            i, W, EDM, err, state = ut.load_checkpoint(resume_from)
+            if EDM.shape[0] != numcells or W.size != D.shape[1]:
+                raise ValueError('The checkpoint in ' + str(resume_from) +
+                                 ' does not match the loaded data.')
+            if verbose:
+                print('RESUMING SAM from iteration ' + str(i))
+            new = W
+            if 'pca_gene_indices' in state and pca_solver == 'iterative':
+                # the PCA of the checkpointed iteration seeds the solver
+                wPCA_data = self.calculate_wpca(
+                    D, state['pca_gene_indices'], state['pca_gene_weights'],
+                    preprocessing, npcs, weight_PCs)
+            if 'rng_keys' in state:
+                np.random.set_state(
+                    ('MT19937', state['rng_keys'], int(state['rng_pos']),
+                     int(state['rng_has_gauss']),
+                     float(state['rng_cached_gaussian'])))
 
-        if verbose:
-            print('RUNNING SAM')
+        else:
+            nums = np.arange(numcells)
+            RINDS = np.random.randint(
+                0, numcells, (k - 1) * numcells).reshape((numcells,(k - 1)))
+            RINDS = np.hstack((nums[:, None], RINDS))
 
-        W = self.dispersion_ranking_NN(
-            edm, num_norm_avg=1)
+            edm = ut.gen_sparse_knn(RINDS)
 
-        old = np.zeros(W.size)
-        new = W
+            if verbose:
+                print('RUNNING SAM')
 
-        i = 0
-        err = ((new - old)**2).mean()**0.5
+            W = self.dispersion_ranking_NN(
+                edm, num_norm_avg=1, save_avg=store_knn_avg == 'always')
+
+            old = np.zeros(W.size)
+            new = W
+
+            i = 0
+            err = ((new - old)**2).mean()**0.5
+            EDM = None
 
         if max_iter < 5:
             max_iter = 5
 
         nnas = num_norm_avg
 
-        while (i < max_iter and err > stopping_condition):
+        n_full = int(state.get('n_full', i))
+        frac = float(state.get('frac', 1. if schedule is None else 0.25))
+        converged = bool(state.get('converged', False))
+        prev_err = np.inf
+        log = []
+        while (not converged and n_full < max_iter and (
+                err > stopping_condition or (schedule is not None and
+                                             n_full < 2))):
 
             conv = err
             if(verbose):
                 print('Iteration: ' + str(i) + ', Convergence: ' + str(conv))
 
+            if schedule is not None and frac < 1:
+                if err <= 0.03 or err <= stopping_condition:
+                    frac = 1.
+                elif err <= 0.1 or err > 0.5 * prev_err:
+                    # refine once the error drops or stalls at the noise
+                    # level of the subsampled cells
+                    frac = min(2 * frac, 1.)
+
             i += 1
             old = new
-
-            W, wPCA_data, EDM, = self.calculate_nnm(
-                D, W, n_genes, preprocessing, npcs, numcells, nnas, weight_PCs)
+            prev_err = err
+            tstart = time.time()
+
+            if frac < 1:
+                n_cells_i = max(int(frac * numcells), min(numcells, 2000))
+                npcs_i = max(int(frac * npcs), min(npcs, 20))
+                n_genes_i = max(int(frac * n_genes), min(n_genes, 1000))
+                cells = np.sort(np.random.choice(numcells, n_cells_i,
+                                                 replace=False))
+                W = self.calculate_coarse_weights(
+                    D, W, cells, n_genes_i, preprocessing, npcs_i, nnas,
+                    weight_PCs)
+            else:
+                n_cells_i, npcs_i, n_genes_i = numcells, npcs, n_genes
+                W, wPCA_data, EDM, = self.calculate_nnm(
+                    D, W, n_genes, preprocessing, npcs, numcells, nnas,
+                    weight_PCs, prev_nnm=EDM)
+                n_full += 1
             new = W
             err = ((new - old)**2).mean()**0.5
+            log.append([i, n_cells_i, npcs_i, n_genes_i, err,
+                        time.time() - tstart])
+
+            if checkpoint is not None and frac == 1:
+                rng = np.random.get_state()
+                ut.save_checkpoint(checkpoint, i, W, EDM, err, state={
+                    'n_full': n_full, 'frac': frac,
+                    'converged': err <= stopping_condition and (
+                        schedule is None or n_full >= 2),
+                    'pca_gene_indices': self.adata.uns['pca_gene_indices'],
+                    'pca_gene_weights': self.adata.uns['pca_gene_weights'],
+                    'rng_keys': rng[1], 'rng_pos': rng[2],
+                    'rng_has_gauss': rng[3], 'rng_cached_gaussian': rng[4]})
+
+        self.adata.uns['run_log'] = pd.DataFrame(
+            log, columns=['iteration', 'n_cells', 'npcs', 'n_genes', 'error',
+                          'seconds'])
+
+        if not log and 'pca_gene_indices' not in state:
+            # resumed from a finished run's checkpoint that does not hold the
+            # genes of its last iteration
+            W, wPCA_data, EDM, = self.calculate_nnm(
+                D, W, n_genes, preprocessing, npcs, numcells, nnas, weight_PCs,
+                prev_nnm=EDM)
+        elif not log:
+            # resumed from a finished run's checkpoint: the gene weights of
+            # its last iteration are kept, its PCA is recomputed from the
+            # genes and weights it used, and the dispersions and the
+            # kNN-averaged expression are restored from its graph
+            if wPCA_data is None:
+                rng = np.random.get_state()
+                wPCA_data = self.calculate_wpca(
+                    D, state['pca_gene_indices'], state['pca_gene_weights'],
+                    preprocessing, npcs, weight_PCs)
+                np.random.set_state(rng)
+            self.knn_index = None
+            self.dispersion_ranking_NN(
+                EDM, num_norm_avg=nnas, save_avg=store_knn_avg == 'always')
+            self.adata.var['weights'] = W
 
         all_gene_names = np.array(list(self.adata.var_names))
         indices = np.argsort(-W)
@@ -934,6 +1281,35 @@ class SAM(object):
         self.adata.uns['neighbors'] = {}
         self.adata.uns['neighbors']['connectivities'] = EDM
 
+        if store_knn_avg == 'final':
+            # the weights of the last iteration are kept; only the averaged
+            # expression matrix is materialized
+            self.get_knn_avg()
+
+        if (self.knn_index is not None and
+                self.knn_index.method in ut.EXACT_KNN_METHODS):
+            self.adata.uns['knn_recall'] = 1.
+        else:
+            self.adata.uns['knn_recall'] = ut.knn_recall(
+                wPCA_data, EDM, metric=self.run_args['distance'])
+            if verbose:
+                print('kNN recall: ' + str(self.adata.uns['knn_recall']))
+
+        self.run_projection(projection, verbose=verbose, **proj_kwargs)
+
+        self.adata.uns['run_args'] = self.run_args
+        elapsed = time.time() - tinit
+        if verbose:
+            print('Elapsed time: ' + str(elapsed) + ' seconds')
+
+
+
+
+    def run_projection(self, projection='umap', verbose=True, **proj_kwargs):
+        """Computes the 'projection' ('umap', 'tsne', 'diff_umap', or None)
+        embedding of the SAM output. Keyword arguments are passed to the
+        corresponding 'run_*' function."""
+        D = self.adata.X
         if(projection == 'tsne'):
             if verbose:
                 print('Computing the t-SNE embedding...')
@@ -953,13 +1329,615 @@ class SAM(object):
                 print('Computing the diffusion UMAP embedding...')
             self.run_diff_umap(**proj_kwargs)
 
+    def run_sketch(self, n_sketch=20000, sketch_method='geometric',
+                   sketch_npcs=20, chunk_size=20000, seed=0, **run_kwargs):
+        """Runs SAM on a representative sketch of the cells and projects all
+        remaining cells onto the result.
+
+        The sketch is chosen in a quick PCA of all cells. SAM is run to
+        convergence on the sketch, after which every cell is normalized with
+        the final gene weights and projected onto the sketch's principal
+        axes with 'ut.transform_wPCA' in chunks of 'chunk_size' cells. Each
+        cell's nearest neighbors are then found among the sketched cells and
+        its kNN-averaged expression is computed from them. The same .adata
+        fields as 'run' are filled for all cells, and the sketched cells are
+        marked in .adata.obs['sketch'].
+
+        Parameters
+        ----------
+        n_sketch - int, optional, default 20000
+            The number of sketched cells.
+
+        sketch_method - str, optional, default 'geometric'
+            'geometric' samples cells evenly over the occupied regions of PC
+            space (geometric sketching), 'density' samples cells with
+            probabilities inversely related to their local density, and
+            'uniform' samples cells uniformly at random.
+
+        sketch_npcs - int, optional, default 20
+            The number of principal components in which the sketch is chosen.
+
+        chunk_size - int, optional, default 20000
+            The number of cells projected at a time.
+
+        seed - int, optional, default 0
+            The random seed of the sketch.
+
+        **run_kwargs - keyword arguments passed to 'run' for the sketch.
+        """
+        tinit = time.time()
+        verbose = run_kwargs.get('verbose', True)
+        projection = run_kwargs.pop('projection', 'umap')
+        proj_kwargs = run_kwargs.pop('proj_kwargs', {})
+        numcells = self.adata.shape[0]
+
+        if sketch_method not in ('geometric', 'density', 'uniform'):
+            raise ValueError(
+                "'sketch_method' must be 'geometric', 'density', or 'uniform'.")
+
+        if n_sketch >= numcells:
+            sketch = np.arange(numcells)
+        elif sketch_method == 'uniform':
+            sketch = np.sort(np.random.RandomState(seed).choice(
+                numcells, n_sketch, replace=False))
+        else:
+            if verbose:
+                print('Choosing the sketch...')
+            coords = ut.weighted_sparse_PCA(
+                Normalizer().fit_transform(self.adata.X), do_weight=False,
+                npcs=sketch_npcs, seed=seed)[0]
+            if sketch_method == 'geometric':
+                sketch = ut.geometric_sketch(coords, n_sketch, seed=seed)
+            else:
+                sketch = ut.density_sketch(coords, n_sketch, seed=seed)
+            del coords
+
+        # run SAM on the sketch
+        sub = SAM()
+        sub.adata = AnnData(X=self.adata.X[sketch],
+                            obs=self.adata.obs.iloc[sketch].copy(),
+                            var=self.adata.var.copy())
+        sub.adata.layers['X_disp'] = self.adata.layers['X_disp'][sketch]
+        sub.adata_raw = sub.adata
+        sub.preprocess_args = self.preprocess_args
+        sub.run(projection=None, **run_kwargs)
+
+        self.run_args = dict(sub.run_args)
+        self.run_args.update({'projection': projection,
+                              'n_sketch': sketch.size,
+                              'sketch_method': sketch_method})
+        preprocessing = self.run_args['preprocessing']
+        distance = self.run_args['distance']
+        k = self.run_args['k']
+        gkeep = sub.adata.uns['pca_gene_indices']
+        Wg = sub.adata.uns['pca_gene_weights']
+        pca = sub.adata.uns['pca_obj']
+
+        # project all cells onto the principal axes of the sketch
+        if verbose:
+            print('Projecting all cells...')
+        scaler = None
+        if preprocessing == 'StandardScaler':
+            scaler = self.fit_scaler(gkeep, cells=sketch)
+        X_pca = self.transform_pca(self.adata.X, gkeep, Wg, pca,
+                                   scaler=scaler, chunk_size=chunk_size)
+
+        # nearest neighbors of every cell among the sketched cells, in the
+        # space of 'run' (L2-normalized PCs for the euclidean distance)
+        if distance == 'euclidean':
+            X_pca = Normalizer().fit_transform(X_pca)
+        knni = ut.knn_query(X_pca[sketch], X_pca, k,
+                            metric=distance,
+                            method=self.run_args.get('knn_method', 'auto'))[0]
+        EDM = ut.gen_sparse_knn(sketch[knni], shape=(numcells, numcells))
+
+        self.adata.var['weights'] = sub.adata.var['weights'].values
+        self.adata.var['spatial_dispersions'] = sub.adata.var[
+            'spatial_dispersions'].values
+        self.adata.uns['ranked_genes'] = sub.adata.uns['ranked_genes']
+        for key in ('pca_obj', 'pca_gene_indices', 'pca_gene_weights'):
+            self.adata.uns[key] = sub.adata.uns[key]
+        self.adata.uns.pop('X_processed', None)
+        self.adata.uns.pop('knn_graph_change', None)
+        del sub
+
+        if self.run_args.get('store_knn_avg', 'always') != 'never':
+            self.adata.layers['X_knn_avg'] = ut.knn_avg(
+                EDM, self.adata.layers['X_disp'],
+                out=self.adata.layers.pop('X_knn_avg', None))
+        elif 'X_knn_avg' in self.adata.layers.keys():
+            del self.adata.layers['X_knn_avg']
+
+        mask = np.zeros(numcells, dtype='bool')
+        mask[sketch] = True
+        self.knn_index = None
+        self.adata.obs['sketch'] = mask
+        self.adata.obsm['X_pca'] = X_pca
+        self.adata.uns['neighbors'] = {}
+        self.adata.uns['neighbors']['connectivities'] = EDM
+
+        self.run_projection(projection, verbose=verbose, **proj_kwargs)
+
         self.adata.uns['run_args'] = self.run_args
         elapsed = time.time() - tinit
         if verbose:
             print('Elapsed time: ' + str(elapsed) + ' seconds')
 
+    def fit_scaler(self, gkeep, cells=None):
+        """Fits the StandardScaler used by 'preprocessing=StandardScaler' to
+        the expression of genes 'gkeep' in 'cells' (all cells if None)."""
+        D = self.adata.X
+        dtype = self.run_args.get('dtype', 'float64')
+        if dtype == 'float32' and D.dtype != dtype:
+            D = D.astype(dtype)
+        Ds = self.calculate_weighted_data(D, gkeep, np.ones(gkeep.size),
+                                          None, cells=cells)
+        return StandardScaler(with_mean=not sp.issparse(Ds)).fit(Ds)
+
+    def transform_pca(self, D, gkeep, Wg, pca, scaler=None,
+                      chunk_size=20000):
+        """Normalizes the cells in 'D' with the gene weights 'Wg' of genes
+        'gkeep' and projects them onto the principal axes of 'pca' in chunks
+        of 'chunk_size' cells. Returns the (cells x PCs) coordinates."""
+        dtype = self.run_args.get('dtype', 'float64')
+        preprocessing = self.run_args.get('preprocessing', 'StandardScaler')
+        if dtype == 'float32' and D.dtype != dtype:
+            D = D.astype(dtype)
+
+        numcells = D.shape[0]
+        X_pca = np.zeros((numcells, pca.components_.shape[0]), dtype=dtype)
+        for start in range(0, numcells, chunk_size):
+            cells = np.arange(start, min(numcells, start + chunk_size))
+            Ds = self.calculate_weighted_data(D, gkeep, Wg, preprocessing,
+                                              scaler=scaler, cells=cells)
+            if self.run_args.get('weight_PCs', True):
+                X_pca[cells] = ut.transform_wPCA(Ds, pca)
+            else:
+                X_pca[cells] = np.asarray(Ds - pca.mean_).dot(
+                    pca.components_.T)
+        return X_pca
+
+    def get_knn_index(self):
+        """Returns the nearest-neighbor index (utilities.NNIndex) of the
+        cells in the final PC space (.adata.obsm['X_pca']).
+
+        The index built by the last iteration of 'run' is reused if there
+        is one. Otherwise an index is built and kept in .knn_index. The
+        index is saved and loaded with the SAM object. Query points must be
+        in the same space, e.g. PCs projected with 'transform_pca' (and
+        L2-normalized if SAM was run with distance='euclidean').
+        """
+        X = self.adata.obsm['X_pca']
+        index = getattr(self, 'knn_index', None)
+        if index is None or index.data.shape[0] != X.shape[0]:
+            distance = self.run_args.get('distance', 'correlation')
+            if distance == 'euclidean':
+                X = Normalizer().fit_transform(X)
+            index = ut.NNIndex(X, metric=distance,
+                               n_neighbors=self.run_args.get('k', 20),
+                               method=self.run_args.get('knn_method', 'auto'))
+            self.knn_index = index
+        return index
+
+    def get_knn_avg(self):
+        """Returns the kNN-averaged expression matrix
+        (.adata.layers['X_knn_avg']).
+
+        If the layer is missing, e.g. because SAM was run with
+        store_knn_avg='never' or a run is still in progress, it is computed
+        from the current nearest-neighbor graph. It is kept in
+        .adata.layers unless SAM was run with store_knn_avg='never'.
+        """
+        if 'X_knn_avg' in self.adata.layers.keys():
+            return self.adata.layers['X_knn_avg']
+
+        D_avg = ut.knn_avg(self.adata.uns['neighbors']['connectivities'],
+                           self.adata.layers['X_disp'])
+        if self.run_args.get('store_knn_avg', 'always') != 'never':
+            self.adata.layers['X_knn_avg'] = D_avg
+        return D_avg
+
+    def map_query(self, adata_query, labels=None, embeddings=None, k=None,
+                  chunk_size=20000, verbose=True):
+        """Maps new cells onto this SAM analysis without rerunning SAM.
+
+        The query is normalized like the reference (see .preprocess_args),
+        with the sum-normalization factors (e.g. the median total count for
+        sum_norm='cell_median') of the reference cells, and restricted to
+        the reference's genes. Its cells are projected
+        onto the reference's principal axes with the reference's gene
+        weights. Each query cell's nearest neighbors are then found among
+        the reference cells with the persistent nearest-neighbor index (see
+        'get_knn_index'). Annotations are transferred by majority vote
+        of the neighbors, and embedding coordinates are the mean of the
+        neighbors' coordinates.
 
+        Parameters
+        ----------
+        adata_query - AnnData
+            The raw (unnormalized) expression data of the query cells. Genes
+            are matched to the reference by name; reference genes missing
+            from the query are treated as unexpressed.
 
+        labels - list of str, optional, default None
+            The .adata.obs columns to transfer. If None, transfers all
+            categorical and string columns.
+
+        embeddings - list of str, optional, default None
+            The .adata.obsm keys to transfer. If None, transfers 'X_umap' and
+            'X_tsne' if they exist.
+
+        k - int, optional, default None
+            The number of reference neighbors per query cell. If None, uses
+            the 'k' of the reference run.
+
+        chunk_size - int, optional, default 20000
+            The number of query cells projected at a time.
+
+        Returns
+        -------
+        A SAM object of the query cells. Its .adata.obsm['X_pca'] holds the
+        projected PCs (L2-normalized for the euclidean distance, like the
+        reference's), transferred annotations are stored in .adata.obs
+        (together with the fraction of agreeing neighbors in
+        '<label>_score'), transferred embeddings in .adata.obsm, and the
+        (query x reference) nearest neighbor graph in
+        .adata.uns['mapping']['connectivities'].
+        """
+        tinit = time.time()
+        if 'pca_obj' not in self.adata.uns.keys():
+            raise ValueError('SAM must be run before mapping query cells.')
+
+        # align the query genes to the reference genes
+        ref_genes = np.array(list(self.adata.var_names))
+        query_genes = np.array(list(adata_query.var_names))
+        gene_index = pd.Series(np.arange(ref_genes.size), index=ref_genes)
+        present = np.where(np.isin(query_genes, ref_genes))[0]
+        Q = adata_query.X
+        if not sp.issparse(Q):
+            Q = sp.csr_matrix(Q)
+        Q = sp.csr_matrix(Q.tocsr()[:, present], dtype='float32')
+        Q.indices = gene_index[query_genes[present]].values[
+            Q.indices].astype(Q.indices.dtype)
+        Q = sp.csr_matrix((Q.data, Q.indices, Q.indptr),
+                          shape=(Q.shape[0], ref_genes.size))
+        Q.sort_indices()
+
+        # normalize the query like the reference, with the normalization
+        # factors resolved from the reference cells
+        args = self.preprocess_args
+        clip = args.get('clip_residuals', None)
+        if clip == 'auto':
+            clip = np.sqrt(self.adata.shape[0])
+        sum_norm = self.adata.uns.get('sum_norm', args.get('sum_norm', None))
+        if 'gene_sums' in self.adata.var.keys():
+            Q = sp.csr_matrix(Q.multiply(
+                sum_norm / self.adata.var['gene_sums'].values[None, :]),
+                dtype='float32')
+            sum_norm = None
+        query = SAM(counts=AnnData(X=Q, obs=pd.DataFrame(
+            index=adata_query.obs_names), var=pd.DataFrame(index=ref_genes)))
+        query.preprocess_data(
+            div=args.get('div', 1), sum_norm=sum_norm,
+            norm=args.get('norm', 'log'),
+            min_expression=args.get('min_expression', 1),
+            filter_genes=False, clip_residuals=clip,
+            dense_residuals=args.get('dense_residuals', False))
+        mask = self.adata.var['mask_genes'].values
+        if args.get('norm', None) == 'multinomial':
+            # residuals relative to the reference gene fractions
+            pj = self.adata.var['gene_fraction'].values
+            query.adata.var['gene_fraction'] = pj
+            query.adata.X = ut.filter_sparse(ut.pearson_residuals(
+                Q, pj=pj, clip=clip)[0], mask, keep_zeros=True)
+        else:
+            query.adata.X = ut.filter_sparse(query.adata.X, mask)
+        query.adata.layers['X_disp'] = ut.filter_sparse(
+            query.adata.layers['X_disp'], mask)
+        query.adata.var['mask_genes'] = mask
+        query.run_args = dict(self.run_args)
+
+        # project the query onto the reference PCs
+        if verbose:
+            print('Projecting query cells...')
+        gkeep = self.adata.uns['pca_gene_indices']
+        Wg = self.adata.uns['pca_gene_weights']
+        scaler = None
+        if self.run_args.get('preprocessing', None) == 'StandardScaler':
+            scaler = self.fit_scaler(gkeep)
+        X_pca = query.transform_pca(query.adata.X, gkeep, Wg,
+                                    self.adata.uns['pca_obj'],
+                                    scaler=scaler, chunk_size=chunk_size)
+
+        # nearest reference neighbors of every query cell
+        if k is None:
+            k = self.run_args.get('k', 20)
+        distance = self.run_args.get('distance', 'correlation')
+        if distance == 'euclidean':
+            X_pca = Normalizer().fit_transform(X_pca)
+        knni = self.get_knn_index().query(X_pca, k=k)[0]
+
+        query.adata.obsm['X_pca'] = X_pca
+        query.adata.uns['mapping'] = {'connectivities': ut.gen_sparse_knn(
+            knni, shape=(X_pca.shape[0], self.adata.shape[0]))}
+
+        # transfer annotations and embeddings
+        if labels is None:
+            labels = [key for key in self.adata.obs.keys() if
+                      self.adata.obs[key].dtype.name in ('category',
+                                                         'object')]
+        for key in labels:
+            cats = pd.Categorical(self.adata.obs[key].values)
+            votes = cats.codes[knni]
+            counts = np.zeros((knni.shape[0], cats.categories.size + 1))
+            np.add.at(counts, (np.arange(knni.shape[0])[:, None], votes), 1)
+            # unannotated (NaN, code -1) neighbors fall in the last column
+            best = counts[:, :-1].argmax(1)
+            query.adata.obs[key] = pd.Categorical.from_codes(
+                best, cats.categories)
+            query.adata.obs[key + '_score'] = counts[
+                np.arange(best.size), best] / k
+
+        if embeddings is None:
+            embeddings = [key for key in ('X_umap', 'X_tsne') if
+                          key in self.adata.obsm.keys()]
+        for key in embeddings:
+            query.adata.obsm[key] = self.adata.obsm[key][knni].mean(1)
+
+        if verbose:
+            print('Elapsed time: ' + str(time.time() - tinit) + ' seconds')
+        return query
+
+    def run_ensemble(self, n_runs=10, seeds=None, n_jobs=None,
+                     **run_kwargs):
+        """Runs SAM several times with different random initial graphs in a
+        pool of worker processes.
+
+        The processed expression data is placed in shared memory once and
+        mapped by every worker without copying. The number of BLAS and numba
+        threads per worker is capped so that the pool does not oversubscribe
+        the available cores.
+
+        Parameters
+        ----------
+        n_runs - int, optional, default 10
+            The number of SAM replicates. Ignored if 'seeds' is provided.
+
+        seeds - array-like of int, optional, default None
+            The random seeds of the replicates. If None, uses 0..n_runs-1.
+
+        n_jobs - int, optional, default None
+            The number of worker processes. If None, uses one process per
+            core (up to the number of replicates).
+
+        **run_kwargs - keyword arguments passed to 'run'. By default no
+            projection is computed ('projection=None') and 'verbose=False'.
+
+        Returns
+        -------
+        A list of dictionaries, one per replicate, with the keys 'seed',
+        'weights', 'connectivities', and 'X_pca' (and 'X_umap' or 'X_tsne'
+        if a projection was computed).
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if seeds is None:
+            seeds = np.arange(n_runs)
+        seeds = [int(x) for x in seeds]
+
+        n_cpus = os.cpu_count() or 1
+        if n_jobs is None:
+            n_jobs = n_cpus
+        n_jobs = max(1, min(n_jobs, len(seeds)))
+        n_threads = max(1, n_cpus // n_jobs)
+
+        run_kwargs.setdefault('projection', None)
+        run_kwargs.setdefault('verbose', False)
+
+        X = sp.csr_matrix(self.adata.X)
+        arrays = [X.data, X.indices, X.indptr]
+        X_disp = self.adata.layers['X_disp']
+        if X_disp is not self.adata.X:
+            X_disp = sp.csr_matrix(X_disp)
+            arrays += [X_disp.data, X_disp.indices, X_disp.indptr]
+
+        # the totals used by the dense Pearson residuals
+        obs = {key: self.adata.obs[key].values for key in ('total_counts',)
+               if key in self.adata.obs.keys()}
+        var = {key: self.adata.var[key].values for key in ('gene_fraction',)
+               if key in self.adata.var.keys()}
+
+        blocks, specs = ut.share_arrays(arrays)
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=n_jobs,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=ut.limit_threads,
+                    initargs=(n_threads,)) as pool:
+                results = list(pool.map(
+                    ut.ensemble_worker,
+                    [(specs, X.shape, seed, run_kwargs, self.preprocess_args,
+                      obs, var) for seed in seeds]))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        return results
+
+    def run_sweep(self, k=(20,), npcs=(150,), n_genes=(3000,),
+                  cluster_method='leiden', cluster_param=None,
+                  num_norm_avg=50, converge=True, max_iter=10,
+                  stopping_condition=None, seed=0, verbose=True):
+        """Runs SAM over a grid of 'k', 'npcs', and 'n_genes' values starting
+        from the current gene weights.
+
+        The first SAM iteration of every grid point is shared: the weighted
+        data is computed once per 'n_genes' value, PCA is computed once at
+        the largest 'npcs' and truncated for smaller values, and the nearest
+        neighbors are found once at the largest 'k' and sliced for smaller
+        values. The resulting kNN graph updates the gene weights. If
+        'converge' is True, each grid point is then iterated like 'run'
+        until the gene weights converge, reusing the preprocessed data.
+        Otherwise, the sweep stops after the shared iteration, a cheap probe
+        of the sensitivity of the current weights to the parameters that
+        does not give the converged SAM output. The final kNN graph of each
+        parameter set is used to cluster the cells.
+
+        Requires that 'run' was called first. The preprocessing, distance,
+        PCA solver, PC weighting, and kNN method settings are taken from
+        .run_args.
+
+        Parameters
+        ----------
+        k - array-like of int, optional, default (20,)
+            The numbers of nearest neighbors.
+
+        npcs - array-like of int, optional, default (150,)
+            The numbers of principal components.
+
+        n_genes - array-like of int, optional, default (3000,)
+            The numbers of top-weighted genes used in PCA. None uses all
+            genes.
+
+        cluster_method - str, optional, default 'leiden'
+            'leiden', 'leiden_sig', 'louvain', and 'louvain_sig' cluster the
+            kNN graph, 'kmeans' clusters the (normalized) PCs. If None, no
+            clustering is performed.
+
+        cluster_param - float, optional, default None
+            The parameter of the clustering method (see 'clustering').
+
+        num_norm_avg - int, optional, default 50
+            See 'dispersion_ranking_NN'.
+
+        converge - bool, optional, default True
+            If True, every grid point is iterated until the RMSE between
+            successive gene weights drops below 'stopping_condition' (or
+            'max_iter' iterations, including the shared one, are done).
+            Otherwise, only the shared iteration is done.
+
+        max_iter - int, optional, default 10
+            The maximum number of iterations per grid point.
+
+        stopping_condition - float, optional, default None
+            The convergence threshold. If None, uses the one of the last
+            'run'.
+
+        seed - int, optional, default 0
+            The random seed of the k-means clustering.
+
+        Returns
+        -------
+        (weights, labels) - two tidy pandas.DataFrames with columns
+        'n_genes', 'npcs', 'k' and, respectively, 'gene' and 'weight' or
+        'cell' and 'cluster'.
+        """
+        if 'weights' not in self.adata.var.keys():
+            raise ValueError("Run SAM with 'run' before sweeping parameters.")
+
+        if cluster_method not in (None, 'leiden', 'leiden_sig', 'louvain',
+                                  'louvain_sig', 'kmeans'):
+            raise ValueError(
+                "'cluster_method' must be None, 'leiden', 'leiden_sig', "
+                "'louvain', 'louvain_sig', or 'kmeans'.")
+
+        preprocessing = self.run_args.get('preprocessing', 'Normalizer')
+        distance = self.run_args.get('distance', 'correlation')
+        knn_method = self.run_args.get('knn_method', 'auto')
+        weight_PCs = self.run_args.get('weight_PCs', True)
+        dtype = self.run_args.get('dtype', 'float64')
+        if stopping_condition is None:
+            stopping_condition = self.run_args.get('stopping_condition', 5e-3)
+
+        D = self.adata.X
+        X_disp = self.adata.layers['X_disp']
+        W = self.adata.var['weights'].values
+        genes = np.array(list(self.adata.var_names))
+        cells = np.array(list(self.adata.obs_names))
+        n_expr = (D.sum(0) > 0).sum()
+
+        k = np.sort(np.unique(k)).astype('int')
+        npcs = np.sort(np.unique(npcs)).astype('int')
+
+        def select_genes(W, ng):
+            if ng is None:
+                return np.arange(W.size)
+            return np.sort(np.argsort(-W)[:min(ng, n_expr)])
+
+        def iterate(W, ng, npc, kk):
+            # one SAM iteration of a single grid point
+            gkeep = select_genes(W, ng)
+            D_sub = self.calculate_weighted_data(
+                D, gkeep, W[gkeep].astype(dtype), preprocessing)
+            g_weighted = self.calculate_pcs(D_sub, gkeep, npc, weight_PCs)[0]
+            if distance == 'euclidean':
+                g_weighted = Normalizer().fit_transform(g_weighted)
+            EDM = ut.gen_sparse_knn(ut.knn_search(
+                g_weighted, kk, distance, method=knn_method)[0])
+            mu, var = ut.knn_avg_moments(EDM, X_disp)
+            return (ut.dispersion_weights(mu, var, num_norm_avg)[0],
+                    g_weighted, EDM)
+
+        weights = []
+        labels = []
+        for ng in n_genes:
+            gkeep = select_genes(W, ng)
+            Wg = W[gkeep].astype(dtype)
+            D_sub = self.calculate_weighted_data(D, gkeep, Wg, preprocessing)
+            g_all = self.calculate_pcs(D_sub, gkeep, npcs[-1], weight_PCs)[0]
+
+            for npc in npcs:
+                g_weighted = g_all[:, :npc]
+                if distance == 'euclidean':
+                    g_weighted = Normalizer().fit_transform(g_weighted)
+                knni = ut.knn_search(g_weighted, k[-1], distance,
+                                     method=knn_method)[0]
+
+                for kk in k:
+                    if verbose:
+                        print('n_genes={}, npcs={}, k={}'.format(ng, npc, kk))
+                    EDM = ut.gen_sparse_knn(knni[:, :kk])
+                    mu, var = ut.knn_avg_moments(EDM, X_disp)
+                    Wk = ut.dispersion_weights(mu, var, num_norm_avg)[0]
+                    g_k = g_weighted
+
+                    err = ((Wk - W)**2).mean()**0.5
+                    n_iter = 1
+                    while (converge and err > stopping_condition and
+                           n_iter < max_iter):
+                        W_old = Wk
+                        Wk, g_k, EDM = iterate(Wk, ng, npc, kk)
+                        err = ((Wk - W_old)**2).mean()**0.5
+                        n_iter += 1
+
+                    weights.append(pd.DataFrame({
+                        'n_genes': ng, 'npcs': npc, 'k': kk,
+                        'gene': genes, 'weight': Wk}))
+
+                    if cluster_method == 'kmeans':
+                        from sklearn.cluster import KMeans
+                        numc = 6 if cluster_param is None else cluster_param
+                        cl = KMeans(n_clusters=numc,
+                                    random_state=seed).fit_predict(
+                            Normalizer().fit_transform(g_k))
+                    elif cluster_method is not None:
+                        cl = self.clustering(X=EDM, param=cluster_param,
+                                             method=cluster_method)
+                    else:
+                        continue
+                    labels.append(pd.DataFrame({
+                        'n_genes': ng, 'npcs': npc, 'k': kk,
+                        'cell': cells, 'cluster': cl}))
+
+        weights = pd.concat(weights, ignore_index=True)
+        if len(labels) > 0:
+            labels = pd.concat(labels, ignore_index=True)
+        else:
+            labels = pd.DataFrame(
+                columns=['n_genes', 'npcs', 'k', 'cell', 'cluster'])
+        return weights, labels
 
     def calculate_nnm(
             self,
@@ -970,7 +1948,8 @@ class SAM(object):
             npcs,
             numcells,
             num_norm_avg,
-            weight_PCs):
+            weight_PCs,
+            prev_nnm=None):
 
         k = self.run_args.get('k',20)
         distance = self.run_args.get('distance','correlation')
@@ -980,47 +1959,184 @@ class SAM(object):
         else:
             gkeep = np.sort(np.argsort(-W)[:n_genes])
 
-        if preprocessing == 'Normalizer':
-            Ds = D[:, gkeep]
-            if sp.issparse(Ds):
-                  Ds=Ds.toarray()
+        dtype = self.run_args.get('dtype', 'float64')
+        Wg = W[gkeep].astype(dtype)
 
-            Ds = Normalizer().fit_transform(Ds)
+        g_weighted = self.calculate_wpca(D, gkeep, Wg, preprocessing, npcs,
+                                         weight_PCs)
 
-        elif preprocessing == 'StandardScaler':
-            Ds = D[:, gkeep]
-            if sp.issparse(Ds):
-                  Ds=Ds.toarray()
+        knn_init = None
+        if (prev_nnm is not None and
+                self.run_args.get('incremental_knn', False) and
+                np.all(np.diff(prev_nnm.indptr) == k)):
+            knn_init = prev_nnm.indices.reshape((numcells, k))
 
-            Ds = StandardScaler(with_mean=True).fit_transform(Ds)
-            Ds[Ds > 10] = 10
-            Ds[Ds < -10] = -10
+        knni, knnd, self.knn_index = ut.knn_search(
+            g_weighted, k, distance, knn_init=knn_init,
+            method=self.run_args.get('knn_method', 'auto'),
+            return_index=True)
+        EDM = ut.gen_sparse_knn(knni)
 
-        else:
-            Ds = D[:, gkeep].toarray()
+        if prev_nnm is not None:
+            self.adata.uns['knn_graph_change'] = 1 - (
+                EDM.multiply(prev_nnm).nnz / float(EDM.nnz))
 
-        D_sub = Ds * (W[gkeep])
+        W = self.dispersion_ranking_NN(
+            EDM, num_norm_avg=num_norm_avg, save_avg=self.run_args.get(
+                'store_knn_avg', 'always') == 'always')
+
+        return W, g_weighted, EDM
+
+    def calculate_wpca(self, D, gkeep, Wg, preprocessing, npcs, weight_PCs):
+        """Computes the PCA of the genes 'gkeep' of 'D' scaled by the gene
+        weights 'Wg' and stores its outputs in .adata.uns. Returns the PCs,
+        L2-normalized for the euclidean distance."""
+        D_sub = self.calculate_weighted_data(D, gkeep, Wg, preprocessing)
+
+        g_weighted, pca = self.calculate_pcs(D_sub, gkeep, npcs, weight_PCs)
+        if self.run_args.get('distance', 'correlation') == 'euclidean':
+            g_weighted = Normalizer().fit_transform(g_weighted)
 
-        if numcells > 500:
-            g_weighted, pca = ut.weighted_PCA(D_sub, npcs=min(
-                npcs, min(D.shape)), do_weight=weight_PCs, solver='auto')
+        self.adata.uns['pca_obj'] = pca
+        self.adata.uns['pca_gene_indices'] = gkeep
+        self.adata.uns['pca_gene_weights'] = Wg
+
+        if self.run_args.get('low_memory', False):
+            self.adata.uns.pop('X_processed', None)
         else:
-            g_weighted, pca = ut.weighted_PCA(D_sub, npcs=min(
-                npcs, min(D.shape)), do_weight=weight_PCs, solver='full')
+            self.adata.uns['X_processed'] = D_sub
+
+        return g_weighted
+
+    def calculate_coarse_weights(self, D, W, cells, n_genes, preprocessing,
+                                 npcs, num_norm_avg, weight_PCs):
+        """Runs one low-resolution SAM iteration on the subset of 'cells'
+        (used by the coarse-to-fine schedule of 'run'). The kNN graph of the
+        subset is built from 'npcs' PCs of the top 'n_genes' genes, and the
+        new gene weights are computed from the kNN-averaged expression of the
+        subset only. Returns the gene weights without modifying .adata."""
+        k = self.run_args.get('k', 20)
+        distance = self.run_args.get('distance', 'correlation')
+        dtype = self.run_args.get('dtype', 'float64')
+
+        gkeep = np.sort(np.argsort(-W)[:n_genes])
+        Wg = W[gkeep].astype(dtype)
+        D_sub = self.calculate_weighted_data(D, gkeep, Wg, preprocessing,
+                                             cells=cells)
+        g_weighted = self.calculate_pcs(D_sub, gkeep, npcs, weight_PCs)[0]
         if distance == 'euclidean':
             g_weighted = Normalizer().fit_transform(g_weighted)
 
-        self.adata.uns['pca_obj'] = pca
+        knni = ut.knn_search(g_weighted, min(k, cells.size - 1), distance,
+                             method=self.run_args.get('knn_method',
+                                                      'auto'))[0]
+        mu, var = ut.knn_avg_moments(ut.gen_sparse_knn(knni),
+                                     self.adata.layers['X_disp'][cells])
+        return ut.dispersion_weights(mu, var, num_norm_avg)[0]
+
+    def calculate_pcs(self, D_sub, gkeep, npcs, weight_PCs):
+        """Computes the (weighted) principal components of the weighted
+        expression data 'D_sub' of genes 'gkeep' with the solver selected by
+        'pca_solver' in .run_args. Returns the PCs and the PCA object."""
+        pca_solver = self.run_args.get('pca_solver', 'dense')
+        dtype = self.run_args.get('dtype', 'float64')
+        npcs = min(npcs, min(D_sub.shape))
+
+        if pca_solver in ('sparse', 'iterative'):
+            # seed the SVD with the previous iteration's principal axes
+            init = None
+            prev = self.adata.uns.get('pca_obj', None)
+            if pca_solver == 'iterative' and prev is not None:
+                prev_genes = self.adata.uns['pca_gene_indices']
+                init = np.zeros((gkeep.size, prev.components_.shape[0]),
+                                dtype=dtype)
+                init[np.isin(gkeep, prev_genes)] = prev.components_[
+                    :, np.isin(prev_genes, gkeep)].T
+
+            if pca_solver == 'iterative':
+                return ut.weighted_sparse_PCA(
+                    D_sub, npcs=npcs, do_weight=weight_PCs, init=init,
+                    tol=5e-3, n_iter=6)
+            return ut.weighted_sparse_PCA(D_sub, npcs=npcs,
+                                          do_weight=weight_PCs)
+
+        if D_sub.shape[0] > 500:
+            return ut.weighted_PCA(D_sub, npcs=npcs, do_weight=weight_PCs,
+                                   solver='auto')
+        return ut.weighted_PCA(D_sub, npcs=npcs, do_weight=weight_PCs,
+                               solver='full')
+
+    def calculate_weighted_data(self, D, gkeep, Wg, preprocessing,
+                                scaler=None, cells=None):
+        """Normalizes the expression data of the genes in 'gkeep' and scales
+        them by the gene weights 'Wg', yielding the input to PCA. Returns a
+        sparse matrix if SAM is run with a sparse PCA solver (and dense
+        Pearson residuals were not requested) and a dense array otherwise.
+
+        'scaler' is an optional StandardScaler fitted to other cells that is
+        used instead of fitting one to 'D', and 'cells' optionally selects
+        the rows of 'D' to use (e.g. when projecting cells in chunks)."""
+        if cells is not None:
+            D = D[cells]
+        if (self.preprocess_args.get('norm', None) == 'multinomial' and
+                self.preprocess_args.get('dense_residuals', False)):
+            clip = self.preprocess_args.get('clip_residuals', None)
+            if clip == 'auto':
+                clip = np.sqrt(self.adata.shape[0])
+            ni = self.adata.obs['total_counts'].values
+            if cells is not None:
+                ni = ni[cells]
+            D = ut.dense_pearson_residuals(
+                D[:, gkeep], ni, self.adata.var['gene_fraction'].values[gkeep],
+                clip=clip)
+            gkeep = np.arange(gkeep.size)
+
+        elif self.run_args.get('pca_solver', 'dense') in ('sparse',
+                                                          'iterative'):
+            Ds = D[:, gkeep]
+            if not sp.issparse(Ds):
+                Ds = sp.csr_matrix(Ds)
 
+            if preprocessing == 'Normalizer':
+                Ds = Normalizer().fit_transform(Ds)
+            elif preprocessing == 'StandardScaler':
+                if scaler is None:
+                    scaler = StandardScaler(with_mean=False).fit(Ds)
+                Ds = scaler.transform(Ds)
 
-        EDM = ut.calc_nnm(g_weighted,k,distance)
+            return Ds.multiply(Wg[None, :]).tocsr()
 
-        W = self.dispersion_ranking_NN(
-            EDM, num_norm_avg=num_norm_avg)
+        Ds = D[:, gkeep]
+        if sp.issparse(Ds):
+              Ds=Ds.toarray()
+
+        if preprocessing == 'Normalizer':
+            Ds = Normalizer().fit_transform(Ds)
 
-        self.adata.uns['X_processed'] = D_sub
+        elif preprocessing == 'StandardScaler':
+            if scaler is None:
+                scaler = StandardScaler(with_mean=True).fit(Ds)
+            Ds = scaler.transform(Ds)
+            Ds[Ds > 10] = 10
+            Ds[Ds < -10] = -10
 
-        return W, g_weighted, EDM
+        return Ds * Wg
+
+    def get_X_processed(self):
+        """Returns the normalized and weighted expression data used as input
+        to PCA in the last SAM iteration. If SAM was run with
+        'low_memory=True', it is rebuilt from .adata.X on demand."""
+        if 'X_processed' in self.adata.uns.keys():
+            return self.adata.uns['X_processed']
+
+        D = self.adata.X
+        dtype = self.run_args.get('dtype', 'float64')
+        if dtype == 'float32' and D.dtype != dtype:
+            D = D.astype(dtype)
+        return self.calculate_weighted_data(
+            D, self.adata.uns['pca_gene_indices'],
+            self.adata.uns['pca_gene_weights'],
+            self.run_args.get('preprocessing', 'Normalizer'))
 
     def run_tsne(self, X=None, metric='correlation', **kwargs):
         """Wrapper for sklearn's t-SNE implementation.
@@ -1115,13 +2231,10 @@ class SAM(object):
         if idx1.size > 0 and idx0.size > 0:
             xcmap = ut.generate_euclidean_map(X[idx0, :], X[idx1, :])
             knn = np.argsort(xcmap.T, axis=1)[:, :k]
-            nnm = np.zeros(xcmap.shape).T
-            nnm[np.tile(np.arange(knn.shape[0])[:, None],
-                        (1, knn.shape[1])).flatten(),
-                knn.flatten()] = 1
+            nnm = ut.gen_sparse_knn(knn, shape=xcmap.T.shape)
             nnmc = np.zeros((nnm.shape[0], cl.max() + 1))
             for i in range(cl.max() + 1):
-                nnmc[:, i] = nnm[:, cl[idx0] == i].sum(1)
+                nnmc[:, i] = nnm[:, cl[idx0] == i].sum(1).A.flatten()
 
             cl[idx1] = np.argmax(nnmc, axis=1)
 
@@ -1268,8 +2381,11 @@ class SAM(object):
 
         from sklearn.cluster import KMeans
         if X is None:
-            D_sub = self.adata.uns['X_processed']
-            X = ut.weighted_PCA(D_sub,npcs=npcs,do_weight=False)[0]
+            D_sub = self.get_X_processed()
+            if sp.issparse(D_sub):
+                X = ut.weighted_sparse_PCA(D_sub,npcs=npcs,do_weight=False)[0]
+            else:
+                X = ut.weighted_PCA(D_sub,npcs=npcs,do_weight=False)[0]
 
         km = KMeans(n_clusters = numc)
         cl = km.fit_predict(Normalizer().fit_transform(X))
@@ -1324,8 +2440,11 @@ class SAM(object):
         import hdbscan
         if X is None:
             #X = self.adata.obsm['X_pca']
-            D = self.adata.uns['X_processed']
-            X = ut.weighted_PCA(D,npcs=npcs,do_weight=False)[0]
+            D = self.get_X_processed()
+            if sp.issparse(D):
+                X = ut.weighted_sparse_PCA(D,npcs=npcs,do_weight=False)[0]
+            else:
+                X = ut.weighted_PCA(D,npcs=npcs,do_weight=False)[0]
             X = Normalizer().fit_transform(X)
             save = True
         else:
@@ -1343,13 +2462,10 @@ class SAM(object):
         if idx1.size > 0 and idx0.size > 0:
             xcmap = ut.generate_euclidean_map(X[idx0, :], X[idx1, :])
             knn = np.argsort(xcmap.T, axis=1)[:, :k]
-            nnm = np.zeros(xcmap.shape).T
-            nnm[np.tile(np.arange(knn.shape[0])[:, None],
-                        (1, knn.shape[1])).flatten(),
-                knn.flatten()] = 1
+            nnm = ut.gen_sparse_knn(knn, shape=xcmap.T.shape)
             nnmc = np.zeros((nnm.shape[0], cl.max() + 1))
             for i in range(cl.max() + 1):
-                nnmc[:, i] = nnm[:, cl[idx0] == i].sum(1)
+                nnmc[:, i] = nnm[:, cl[idx0] == i].sum(1).A.flatten()
 
             cl[idx1] = np.argmax(nnmc, axis=1)
 
@@ -1393,13 +2509,13 @@ class SAM(object):
             try:
                 keys = np.array(list(self.adata.obs_keys()))
                 lbls = self.adata.obs[ut.search_string(
-                    keys, '_clusters')[0][0]].get_values()
+                    keys, '_clusters')[0][0]].to_numpy()
             except KeyError:
                 print("Please generate cluster labels first or set the "
                       "'labels' keyword argument.")
                 return
         elif isinstance(labels, str):
-            lbls = np.array(list(self.adata.obs[labels].get_values().flatten()))
+            lbls = np.array(list(self.adata.obs[labels].to_numpy().flatten()))
         else:
             lbls = labels
 
@@ -1457,13 +2573,13 @@ class SAM(object):
             try:
                 keys = np.array(list(self.adata.obs_keys()))
                 lbls = self.adata.obs[ut.search_string(
-                    keys, '_clusters')[0][0]].get_values()
+                    keys, '_clusters')[0][0]].to_numpy()
             except KeyError:
                 print("Please generate cluster labels first or set the "
                       "'labels' keyword argument.")
                 return
         elif isinstance(labels, str):
-            lbls = self.adata.obs[labels].get_values().flatten()
+            lbls = self.adata.obs[labels].to_numpy().flatten()
         else:
             lbls = labels
 
@@ -1487,23 +2603,49 @@ class SAM(object):
         return markers
 
    
-    def save(self, savename, dirname=None):
-        """Saves all SAM attributes to a Pickle file.
+    def save(self, savename, dirname=None, save_knn_avg=False,
+             project=False):
+        """Saves all SAM attributes to a Pickle file or a project directory.
 
-        Saves all SAM attributes to a Pickle file which can be later loaded
-        into an empty SAM object.
+        By default, all SAM attributes are saved to a Pickle file which can be
+        later loaded into an empty SAM object. If 'project' is True, each
+        array (including the components of sparse matrices, the gene
+        weights, embeddings, and nearest-neighbor graphs) is instead written
+        to its own '.npy' file in a project directory so that 'load' can
+        memory-map it.
 
         Parameters
         ----------
         savename - string
-            The name of the pickle file (not including the file extension) to
-            write to.
+            The name of the pickle file (the '.p' extension is added if
+            missing) or of the project directory to write to. An existing
+            project directory is replaced.
 
         dirname - string, optional, default None
-            The path/name of the directory in which the Pickle file will be
-            saved. If None, the file will be saved to the current working
+            The path/name of the directory in which the file or project will
+            be saved. If None, it will be saved to the current working
             directory.
+
+        save_knn_avg - bool, optional, default False
+            If True, the kNN-averaged expression in .adata.layers['X_knn_avg']
+            is saved to the project directory as well so that it does not
+            need to be recomputed upon loading. Ignored for Pickle files.
+
+        project - bool, optional, default False
+            If True, saves to a project directory instead of a Pickle file.
         """
+        if(dirname is not None):
+            ut.create_folder(dirname + "/")
+            savename = dirname + "/" + savename
+
+        if project:
+            skip = () if save_knn_avg else (('adata', 'layers', 'X_knn_avg'),)
+            ut.write_project(savename, self.__dict__, skip=skip)
+            return
+
+        if savename[-2:] != '.p':
+            savename = savename + '.p'
+
         pickle_dict = self.__dict__
 
         try:
@@ -1511,29 +2653,35 @@ class SAM(object):
         except:
             0;
 
-        if savename[-2:] != '.p':
-            savename = savename + '.p'
-
-        if(dirname is not None):
-            ut.create_folder(dirname + "/")
-            f = open(dirname + "/" + savename, 'wb')
-        else:
-            f = open(savename, 'wb')
-
+        f = open(savename, 'wb')
         pickle.dump(pickle_dict, f)
         f.close()
 
     def load(self, n, recalc_avg=True):
-        """Loads SAM attributes from a Pickle file.
+        """Loads SAM attributes from a project directory or a Pickle file.
 
-        Loads all SAM attributes from the specified Pickle file into the SAM
-        object.
+        Loads all SAM attributes saved by 'save' into the SAM object. Arrays
+        in project directories are memory-mapped and only read from disk when
+        accessed.
 
         Parameters
         ----------
         n - string
-            The path of the Pickle file.
+            The path of the project directory or Pickle file.
+
+        recalc_avg - bool, optional, default True
+            If True, recomputes the kNN-averaged expression if it was not
+            saved.
         """
+        if os.path.isdir(n):
+            self.__dict__.update(ut.read_project(n))
+            if (recalc_avg and
+                    'X_knn_avg' not in self.adata.layers.keys() and
+                    'neighbors' in self.adata.uns.keys() and
+                    self.run_args.get('store_knn_avg', 'always') != 'never'):
+                self.get_knn_avg()
+            return
+
         f = open(n, 'rb')
         pick_dict = pickle.load(f)
         for i in range(len(pick_dict)):
@@ -2,6 +2,7 @@ import colorlover as cl
 import utilities as ut
 import numpy as np
 import scipy.sparse as sp
+import os
 import ipywidgets as widgets
 import plotly.graph_objs as go
 from SAM import SAM
@@ -87,7 +88,7 @@ class SAMGUI(object):
         self.active_labels = [np.zeros(self.selected[0].size,dtype='int')]
         self.dd_opts=[['']]
         try:
-            self.marker_genes = [np.array(list(sam.adata.var_names))[np.argsort(-sam.adata.var['weights'].get_values())]]
+            self.marker_genes = [np.array(list(sam.adata.var_names))[np.argsort(-sam.adata.var['weights'].values)]]
             self.marker_genes_tt = ['Genes ranked by SAM weights.']
         except KeyError:
             self.marker_genes = [np.array(list(sam.adata.var_names))]
@@ -403,7 +404,9 @@ class SAMGUI(object):
             filetype = path.split('.')[-2]
 
         sam=SAM()
-        if filetype == 'h5ad' or filetype == 'csv':
+        if os.path.isfile(os.path.join(path, 'manifest.json')):
+            sam.load(path)
+        elif filetype == 'h5ad' or filetype == 'csv':
             sam.load_data(path)
         elif filetype == 'p':
             try:
@@ -752,7 +755,7 @@ class SAMGUI(object):
             self.active_labels.append(np.zeros(sam_subcluster.adata.shape[0]))
             self.dd_opts.append([''])
             self.gene_expressions.append(np.zeros(sam_subcluster.adata.shape[0]))
-            self.marker_genes.append(np.array(list(sam_subcluster.adata.var_names))[np.argsort(-sam_subcluster.adata.var['weights'].get_values())])
+            self.marker_genes.append(np.array(list(sam_subcluster.adata.var_names))[np.argsort(-sam_subcluster.adata.var['weights'].values)])
             self.marker_genes_tt.append('Genes ranked by SAM weights.')
             self.ds.append(0)
             i = len(self.sams)-1
@@ -764,7 +767,7 @@ class SAMGUI(object):
             self.out.clear_output()
             with self.out:
                 sam.run(**self.run_args)
-            self.marker_genes[i] = np.array(list(sam.adata.var_names))[np.argsort(-sam.adata.var['weights'].get_values())]
+            self.marker_genes[i] = np.array(list(sam.adata.var_names))[np.argsort(-sam.adata.var['weights'].values)]
             self.marker_genes_tt[i] = 'Genes ranked by SAM weights.'
             execute=True
             self.current_sam=sam
@@ -1005,7 +1008,7 @@ class SAMGUI(object):
 
         lsf = widgets.Button(
             description = 'Save',
-            tooltip = 'Save the current SAM object. Filenames should end with .h5ad or .p.',
+            tooltip = 'Save the current SAM object. Filenames should end with .h5ad, .p, or .sam (project directory).',
             disabled=True,
             layout={'width':'30%'})
 
@@ -1105,7 +1108,7 @@ class SAMGUI(object):
     def reset_view(self,event):
         i=self.stab.selected_index
         self.create_plot(i,self.stab.get_title(i))
-        self.marker_genes[i] = np.array(list(self.sams[i].adata.var_names))[np.argsort(-self.sams[i].adata.var['weights'].get_values())]
+        self.marker_genes[i] = np.array(list(self.sams[i].adata.var_names))[np.argsort(-self.sams[i].adata.var['weights'].values)]
         self.marker_genes_tt[i] = 'Genes ranked by SAM weights.'
         self.cs_box.children[11].children[0].set_trait('tooltip',self.marker_genes_tt[i])
 
@@ -1119,6 +1122,9 @@ class SAMGUI(object):
                 s = self.sams[self.stab.selected_index]
                 s.save(path)
                 s.dispersion_ranking_NN()
+            elif path.split('.')[-1] == 'sam':
+                s = self.sams[self.stab.selected_index]
+                s.save(path, project=True)
             elif (path.split('.')[-1] == 'png' or path.split('.')[-1] == 'pdf'
                   or path.split('.')[-1] == 'eps' or path.split('.')[-1] == 'jpg'):
                 if len(path.split('/'))>1:
@@ -1141,15 +1147,15 @@ class SAMGUI(object):
                     gene=genes[0]
 
                 if self.cs_box.children[5].children[2].value:
-                    x = s.adata[:,gene].layers['X_knn_avg']
+                    x = s.get_knn_avg()[:, s.adata.var_names.get_loc(gene)]
                     if sp.issparse(x):
-                        a = x.A.flatten()
+                        a = x.toarray().flatten()
                     else:
                         a = x.flatten()
                 else:
                     x = s.adata_raw[:,gene].X
                     if sp.issparse(x):
-                        a = x.A.flatten()
+                        a = x.toarray().flatten()
                     else:
                         a = x.flatten()
 
@@ -1157,7 +1163,7 @@ class SAMGUI(object):
                     if a.sum() == 0:
                         x = s.adata_raw[:,gene].X
                         if sp.issparse(x):
-                            a = x.A.flatten()
+                            a = x.toarray().flatten()
                         else:
                             a = x.flatten()
 
@@ -1221,14 +1227,14 @@ class SAMGUI(object):
 
             if text!='' and text_name != '' and selected.sum()!=selected.size:
                 if text_name in list(s.adata.obs.keys()):
-                    a = s.adata.obs[text_name].get_values().copy().astype('<U100')
-                    a[np.in1d(x1,selected_cells)] = text
+                    a = s.adata.obs[text_name].to_numpy().copy().astype('<U100')
+                    a[np.isin(x1,selected_cells)] = text
                     s.adata.obs[text_name] = pd.Categorical(a)
 
                 else:
                     a = np.zeros(s.adata.shape[0],dtype='<U100')
                     a[:]=""
-                    a[np.in1d(x1,selected_cells)] = text
+                    a[np.isin(x1,selected_cells)] = text
                     s.adata.obs[text_name] = pd.Categorical(a)
 
             self.update_dropdowns(it)
@@ -1248,7 +1254,7 @@ class SAMGUI(object):
         selected = self.selected[self.stab.selected_index]
         s = self.sams[self.stab.selected_index]
         if not np.all(selected) and selected.sum() > 0:
-            l = s.adata.layers['X_knn_avg']
+            l = s.get_knn_avg()
             m = l.mean(0).A.flatten()
             ms = l[selected,:].mean(0).A.flatten()
             lsub = l[selected,:]
@@ -1311,7 +1317,7 @@ class SAMGUI(object):
     def display_annotation(self, event):
         key = self.cs_box.children[4].children[1].value
         if key != '':
-            labels = np.array(list(self.sams[self.stab.selected_index].adata.obs[key].get_values()))
+            labels = np.array(list(self.sams[self.stab.selected_index].adata.obs[key].to_numpy()))
 
             self.active_labels[self.stab.selected_index] = labels
             self.update_colors_anno(labels)
@@ -17,7 +17,7 @@ setup(
         'pandas',
         'scikit-learn',
 	'numba',
-	'umap-learn', 'anndata'],
+	'umap-learn', 'anndata', 'pynndescent'],
     extras_require={
         'louvain': [
             'louvain', 'cython', 'python-igraph'],
@@ -25,6 +25,8 @@ setup(
             'leidenalg', 'cython', 'python-igraph'],
         'hdbscan': [
             'hdbscan'],
+        'hnsw': [
+            'hnswlib'],
         'plot': [
             'ipythonwidgets', 'jupyter', 'plotly==4.0.0'],
         'scanpy': [
@@ -6,7 +6,15 @@ date:       10/01/2018
 content:    Tests for SAM.
 """
 # Modules
+import os
+import gzip
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.io
+import scipy.sparse as sp
 from SAM import SAM
+import utilities as ut
 
 
 # Script
@@ -22,3 +30,315 @@ if __name__ == '__main__':
     sam.kmeans_clustering(4)    
     sam.identify_marker_genes_ratio();
     sam.identify_marker_genes_rf();
+
+    sam.run(projection=None, pca_solver='sparse')
+    sam.kmeans_clustering(4)
+
+    # unknown solvers are rejected before any work is done
+    weights = sam.adata.var['weights'].values.copy()
+    try:
+        sam.run(projection=None, pca_solver='Sparse')
+        assert False
+    except ValueError:
+        pass
+    assert (sam.adata.var['weights'].values == weights).all()
+
+    # small datasets use the exact kNN backend
+    assert sam.knn_index.method == 'exact'
+    assert ut.knn_recall(sam.adata.obsm['X_pca'],
+                         sam.adata.uns['neighbors']['connectivities']) == 1
+
+    # without an approximate backend, large datasets are not silently
+    # searched by brute force
+    knn_method_available = ut.knn_method_available
+    ut.knn_method_available = lambda method: False
+    try:
+        assert ut.choose_knn_method(1000, 150) == 'exact'
+        try:
+            ut.choose_knn_method(10**6, 150)
+            assert False
+        except ImportError:
+            pass
+    finally:
+        ut.knn_method_available = knn_method_available
+
+    # the sharded exact search yields the same graph
+    knni = ut.knn_sharded(sam.adata.obsm['X_pca'], sam.run_args['k'],
+                          block_size=500, n_jobs=2)[0]
+    assert (ut.gen_sparse_knn(knni) !=
+            sam.adata.uns['neighbors']['connectivities']).nnz == 0
+
+    # a matrix passed as 'out' is consumed: its buffers hold the new result
+    nnm = sam.adata.uns['neighbors']['connectivities']
+    avg = ut.knn_avg(nnm, sam.adata.layers['X_disp'])
+    data = avg.knn_avg_buffers[0]
+    avg2 = ut.knn_avg(nnm, 2 * sam.adata.layers['X_disp'], out=avg)
+    assert np.shares_memory(avg2.data, data)
+    assert abs(avg2 - 2 * ut.knn_avg(nnm, sam.adata.layers['X_disp'])
+               ).max() < 1e-12
+
+    # SAM hands the previous kNN-averaged layer over to be overwritten
+    data = sam.adata.layers['X_knn_avg'].knn_avg_buffers[0]
+    sam.dispersion_ranking_NN(2 * nnm)
+    assert np.shares_memory(sam.adata.layers['X_knn_avg'].data, data)
+    assert abs(sam.adata.layers['X_knn_avg'] -
+               ut.knn_avg(nnm, sam.adata.layers['X_disp'])).max() < 1e-6
+
+    # pruning a distance graph to its 5 nearest neighbors (the zero
+    # self-distances are not stored)
+    knni, knnd = ut.knn_blocked(sam.adata.obsm['X_pca'], 20)
+    i5, d5 = ut.csr_to_knn(ut.sparse_topk(ut.gen_sparse_knn(knni, knnd), 5))
+    assert (i5 == knni[:, 1:6]).all()
+
+    # the coarse-to-fine schedule always finishes at full size
+    sam.run(projection=None, schedule='coarse_to_fine')
+    log = sam.adata.uns['run_log']
+    assert (log['n_cells'].values[-2:] == sam.adata.shape[0]).all()
+
+    # resuming an interrupted run, or a converged one, from its checkpoint
+    # reproduces the uninterrupted run
+    with tempfile.TemporaryDirectory() as d:
+        np.random.seed(0)
+        sam.run(projection=None, checkpoint=d + '/full')
+        weights = sam.adata.var['weights'].values.copy()
+        X_pca = sam.adata.obsm['X_pca'].copy()
+        assert os.path.getsize(d + '/full') < 1e6
+
+        save_checkpoint = ut.save_checkpoint
+
+        def interrupt(fname, i, *args, **kwargs):
+            save_checkpoint(fname, i, *args, **kwargs)
+            if i == 2:
+                raise KeyboardInterrupt
+
+        ut.save_checkpoint = interrupt
+        np.random.seed(0)
+        try:
+            sam.run(projection=None, checkpoint=d + '/partial')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ut.save_checkpoint = save_checkpoint
+        sam.run(projection=None, resume_from=d + '/partial')
+        assert (sam.adata.var['weights'].values == weights).all()
+        sam.run(projection=None, resume_from=d + '/full')
+        assert (sam.adata.var['weights'].values == weights).all()
+        assert abs(sam.adata.obsm['X_pca'] - X_pca).max() < 1e-8
+
+    # converged grid points agree with 'run' with the same parameters, up
+    # to the variability between random initial graphs, and the one-step
+    # probe is deterministic
+    np.random.seed(0)
+    sam.run(projection=None)
+    weights, labels = sam.run_sweep(k=[10, 20], npcs=[10, 20],
+                                    n_genes=[1000], cluster_method='kmeans')
+    assert labels.shape[0] == 4 * sam.adata.shape[0]
+    probe, probe_labels = sam.run_sweep(k=[10], npcs=[10], n_genes=[1000],
+                                        cluster_method='kmeans',
+                                        converge=False)
+    assert (sam.run_sweep(k=[10], npcs=[10], n_genes=[1000],
+                          cluster_method='kmeans', converge=False)[1] ==
+            probe_labels).values.all()
+    grid = (weights['k'] == 10) & (weights['npcs'] == 10)
+    ref = SAM(counts=sam.adata_raw)
+    ref.preprocess_data()
+    np.random.seed(0)
+    ref.run(projection=None, k=10, npcs=10, n_genes=1000)
+    w_run = ref.adata.var['weights'].values
+    rms = ((weights['weight'].values[grid] - w_run)**2).mean()**0.5
+    assert rms < 1e-2
+    assert rms < ((probe['weight'].values - w_run)**2).mean()**0.5
+
+    # float32 execution should agree with float64 within the documented
+    # tolerance
+    np.random.seed(0)
+    sam.run(projection=None)
+    w64 = sam.adata.var['weights'].values
+    np.random.seed(0)
+    sam.run(projection=None, dtype='float32')
+    w32 = sam.adata.var['weights'].values
+    assert sam.adata.obsm['X_pca'].dtype == 'float32'
+    assert ((w64 - w32)**2).mean()**0.5 < 1e-3
+
+    # the kNN-averaged expression is built on demand when it is not stored
+    sam.run(projection=None, store_knn_avg='never')
+    assert 'X_knn_avg' not in sam.adata.layers.keys()
+    assert sam.get_knn_avg().shape == sam.adata.shape
+    try:
+        sam.run(projection=None, store_knn_avg='Final')
+        assert False
+    except ValueError:
+        pass
+
+    sam.run_sketch(n_sketch=200, projection=None)
+    assert sam.adata.obsm['X_pca'].shape[0] == sam.adata.shape[0]
+    assert sam.adata.obs['sketch'].sum() == 200
+
+    # density sketching oversamples sparse regions
+    rng = np.random.RandomState(0)
+    X = np.vstack((0.1 * rng.randn(4500, 5), rng.randn(500, 5) + 5))
+    assert (ut.density_sketch(X, 500, n_ref=1000) >= 4500).mean() > 0.3
+
+    # mapping reference cells back onto the reference recovers their labels
+    sam.kmeans_clustering(4)
+    query = sam.map_query(sam.adata_raw[:100], labels=['kmeans_clusters'])
+    assert query.adata.obsm['X_pca'].shape[0] == 100
+    assert (query.adata.obs['kmeans_clusters'].values.astype(str) ==
+            sam.adata.obs['kmeans_clusters'].values[:100].astype(str)
+            ).mean() > 0.9
+
+    # query cells are normalized with the factors of the reference cells
+    ref = SAM(counts=sam.adata_raw)
+    ref.preprocess_data(sum_norm='cell_median')
+    ref.run(projection=None)
+    query = ref.map_query(ref.adata_raw[:100])
+    assert abs(query.adata.layers['X_disp'] -
+               ref.adata.layers['X_disp'][:100]).max() == 0
+    assert query.run_args is not ref.run_args
+
+    # project directories round-trip the analysis
+    with tempfile.TemporaryDirectory() as d:
+        sam.save(d + '/sam', save_knn_avg=True, project=True)
+        sam2 = SAM()
+        sam2.load(d + '/sam')
+        assert (sam2.adata.var['weights'] == sam.adata.var['weights']).all()
+        assert (sam2.adata.obsm['X_pca'] == sam.adata.obsm['X_pca']).all()
+
+        # saving over a project leaves no files of the old one behind
+        sam2.save(d + '/sam', project=True)
+        sam3 = SAM()
+        sam3.load(d + '/sam', recalc_avg=False)
+        assert 'X_knn_avg' not in sam3.adata.layers.keys()
+
+        # without 'project', a Pickle file is written
+        sam.save(d + '/sam')
+        assert os.path.isfile(d + '/sam.p')
+
+    # preprocessing backed data in chunks matches the in-memory result
+    with tempfile.TemporaryDirectory() as d:
+        sam.adata_raw.write_h5ad(d + '/raw.h5ad')
+        for kwargs in ({}, {'sum_norm': 'cell_median'},
+                       {'norm': 'multinomial'}):
+            ref = SAM()
+            ref.load_data(d + '/raw.h5ad')
+            ref.preprocess_data(**kwargs)
+            backed = SAM()
+            backed.load_data(d + '/raw.h5ad', backed=True)
+            backed.preprocess_data(chunk_size=100, **kwargs)
+            assert (backed.adata.var_names == ref.adata.var_names).all()
+            assert abs(backed.adata.X - ref.adata.X).max() == 0
+
+    # gzipped 10x directories round-trip the raw counts, and only one
+    # triangle of a symmetric matrix is stored
+    with tempfile.TemporaryDirectory() as d:
+        raw = sam.adata_raw
+        with gzip.open(d + '/matrix.mtx.gz', 'wb') as f:
+            scipy.io.mmwrite(f, sp.coo_matrix(raw.X.T), field='integer')
+        with gzip.open(d + '/barcodes.tsv.gz', 'wt') as f:
+            f.write(''.join(c + '\n' for c in raw.obs_names))
+        with gzip.open(d + '/features.tsv.gz', 'wt') as f:
+            f.write(''.join('ID{}\t{}\tGene Expression\n'.format(i, g)
+                            for i, g in enumerate(raw.var_names)))
+        sam10x = SAM()
+        sam10x.load_data(d)
+        assert (sam10x.adata_raw.X != raw.X).nnz == 0
+        assert (sam10x.adata_raw.obs_names == raw.obs_names).all()
+        assert (sam10x.adata_raw.var_names == raw.var_names).all()
+
+        os.mkdir(d + '/sym')
+        A = sp.random(5, 5, density=0.5, random_state=0)
+        A = sp.coo_matrix(A + A.T)
+        scipy.io.mmwrite(d + '/sym/matrix.mtx', A, symmetry='symmetric')
+        for name in ('barcodes.tsv', 'genes.tsv'):
+            with open(d + '/sym/' + name, 'w') as f:
+                f.write(''.join('x{}\n'.format(i) for i in range(5)))
+        X = ut.read_mtx(d + '/sym', transpose=False)[0]
+        assert abs(X - A).max() < 1e-6
+
+    # the fused normalization and Pearson residual kernels match the scipy
+    # expressions they replace
+    D = sp.csr_matrix(sam.adata_raw.X, dtype='float32')
+    s = np.asarray(D.sum(1, dtype='float64')).flatten()
+    for norm, f in (('log', lambda x: np.log2(x + 1)),
+                    ('ftt', lambda x: np.sqrt(x) + np.sqrt(x + 1) - 1),
+                    ('asin', np.arcsinh)):
+        X = ut.normalize_sparse(D, row_scale=np.median(s) / s, norm=norm)[0]
+        ref = D.multiply(np.median(s) / s[:, None]).tocsr()
+        ref.data[:] = f(ref.data)
+        ref.data[ref.data <= 1] = 0
+        assert abs(X - ref).max() < 1e-4
+
+    R = ut.pearson_residuals(D)[0]
+    pj = np.asarray(D.sum(0, dtype='float64')).flatten() / s.sum()
+    mu = s[np.repeat(np.arange(D.shape[0]), np.diff(D.indptr))] * pj[D.indices]
+    ref = (D.data - mu) / np.sqrt(mu - mu**2 / s[np.repeat(
+        np.arange(D.shape[0]), np.diff(D.indptr))])
+    assert np.abs(R.data - ref).max() < 1e-4
+
+    # residuals that are exactly zero are kept when densifying
+    X = sp.csr_matrix(np.array([[1, 1], [1, 1], [2, 2]], dtype='float32'))
+    R, ni, pj = ut.pearson_residuals(X)
+    R = ut.filter_sparse(R, np.ones(2, dtype='bool'), keep_zeros=True)
+    assert (ut.dense_pearson_residuals(R, ni, pj) == 0).all()
+
+    # the warm-started iterative PCA solver agrees with the dense solver
+    np.random.seed(0)
+    sam.run(projection=None, npcs=50)
+    w_dense = sam.adata.var['weights'].values.copy()
+    np.random.seed(0)
+    sam.run(projection=None, npcs=50, pca_solver='iterative')
+    assert sam.adata.uns['pca_obj'].n_iter_ < 4
+    assert ((sam.adata.var['weights'].values - w_dense)**2).mean()**0.5 < 1e-2
+
+    # seeding NN-descent with the previous graph gives the same weights and
+    # a graph at least as accurate as building it from scratch
+    if ut.knn_method_available('nndescent'):
+        np.random.seed(0)
+        sam.run(projection=None, knn_method='nndescent')
+        w_scratch = sam.adata.var['weights'].values.copy()
+        np.random.seed(0)
+        sam.run(projection=None, knn_method='nndescent', incremental_knn=True)
+        assert ((sam.adata.var['weights'].values - w_scratch)**2
+                ).mean()**0.5 < 1e-2
+        assert ut.knn_recall(sam.adata.obsm['X_pca'],
+                             sam.adata.uns['neighbors']['connectivities']
+                             ) > 0.95
+
+    # low-memory runs give the same result and rebuild the processed matrix
+    # on demand
+    np.random.seed(0)
+    sam.run(projection=None)
+    w_full = sam.adata.var['weights'].values.copy()
+    pca_full = sam.adata.obsm['X_pca'].copy()
+    X_processed = sam.adata.uns['X_processed']
+    np.random.seed(0)
+    sam.run(projection=None, low_memory=True)
+    assert 'X_processed' not in sam.adata.uns.keys()
+    assert (sam.adata.var['weights'].values == w_full).all()
+    assert (sam.adata.obsm['X_pca'] == pca_full).all()
+    assert abs(sam.get_X_processed() - X_processed).max() == 0
+
+    # ensemble replicates do not depend on the number of worker processes
+    serial = sam.run_ensemble(seeds=[0, 1], n_jobs=1)
+    pooled = sam.run_ensemble(seeds=[0, 1], n_jobs=2)
+    for a, b in zip(serial, pooled):
+        assert a['seed'] == b['seed']
+        assert (a['weights'] == b['weights']).all()
+
+    # replicates run the same algorithm as 'run', including dense Pearson
+    # residuals
+    res = SAM(counts=sam.adata_raw)
+    res.preprocess_data(norm='multinomial', dense_residuals=True)
+    np.random.seed(0)
+    res.run(projection=None, verbose=False)
+    replicate = res.run_ensemble(seeds=[0], n_jobs=1)[0]
+    assert ((replicate['weights'] - res.adata.var['weights'].values)**2
+            ).mean()**0.5 < 1e-6
+
+    # reading a table in blocks matches reading it whole with pandas
+    X, cells, genes = ut.read_sparse_table(
+        'example_data/darmanis_data.csv.gz', block_size=2**16, n_jobs=2)
+    df = pd.read_csv('example_data/darmanis_data.csv.gz', index_col=0)
+    assert (X.toarray() == df.values.T.astype('float32')).all()
+    assert (cells == df.columns.astype('str')).all()
+    assert (genes == df.index.astype('str')).all()
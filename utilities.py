@@ -1,18 +1,15 @@
 import numpy as np
+import pandas as pd
+from anndata import AnnData
 import scipy as sp
 import os
 import errno
-from sklearn.decomposition import PCA, TruncatedSVD
-import umap.distances as dist
-
-from umap.rp_tree import rptree_leaf_array, make_forest
-from umap.nndescent import (
-    make_nn_descent,
-)
-
-INT32_MIN = np.iinfo(np.int32).min + 1
-INT32_MAX = np.iinfo(np.int32).max - 1
-
+import tempfile
+import re
+import pickle
+import sklearn.utils.sparsefuncs as sf
+import numba
+from sklearn.decomposition import PCA
 __version__ = '0.6.9'
 
 
@@ -35,6 +32,9 @@ def find_corr_genes(sam, input_gene):
     """
     all_gene_names = np.array(list(sam.adata.var_names))
 
+    if 'X_knn_avg' not in sam.adata.layers.keys():
+        sam.dispersion_ranking_NN(
+            num_norm_avg=sam.run_args.get('num_norm_avg', 50))
     D_avg = sam.adata.layers['X_knn_avg']
 
     input_gene =np.where(all_gene_names==input_gene)[0]
@@ -45,41 +45,153 @@ def find_corr_genes(sam, input_gene):
             "that genes are case sensitive.")
         return
 
-    pw_corr = generate_correlation_map(D_avg.T.A,D_avg[:,input_gene].T.A)
+    pw_corr = generate_correlation_map(D_avg.T.toarray(),D_avg[:,input_gene].T.toarray())
     return all_gene_names[np.argsort(-pw_corr.flatten())]
 
-def nearest_neighbors(X, n_neighbors=15, seed=0, metric='correlation'):
+@numba.njit(fastmath=True, cache=True)
+def knn_dist(x, y, euclidean):
+    s = 0.0
+    if euclidean:
+        for i in range(x.size):
+            d = x[i] - y[i]
+            s += d * d
+        return np.sqrt(s)
+    for i in range(x.size):
+        s += x[i] * y[i]
+    return 1.0 - s
+
+
+@numba.njit(fastmath=True, cache=True)
+def knn_push(indices, dists, j, d):
+    k = indices.size
+    if d >= dists[k - 1]:
+        return 0
+    for a in range(k):
+        if indices[a] == j:
+            return 0
+    a = k - 1
+    while a > 0 and dists[a - 1] > d:
+        indices[a] = indices[a - 1]
+        dists[a] = dists[a - 1]
+        a -= 1
+    indices[a] = j
+    dists[a] = d
+    return 1
+
+
+@numba.njit(parallel=True, cache=True)
+def knn_refine_step(X, indices, dists, rev_indptr, rev_indices, expand,
+                    euclidean):
+    n, k = indices.shape
+    new_indices = indices.copy()
+    new_dists = dists.copy()
+    updates = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        n_rev = rev_indptr[i + 1] - rev_indptr[i]
+        for a in range(k + n_rev):
+            if a < k:
+                j = indices[i, a]
+            else:
+                j = rev_indices[rev_indptr[i] + a - k]
+                updates[i] += knn_push(new_indices[i], new_dists[i], j,
+                                       knn_dist(X[i], X[j], euclidean))
+            if expand[i] or expand[j]:
+                for b in range(k):
+                    c = indices[j, b]
+                    if c != i:
+                        updates[i] += knn_push(
+                            new_indices[i], new_dists[i], c,
+                            knn_dist(X[i], X[c], euclidean))
+    return new_indices, new_dists, updates
+
+
+@numba.njit(parallel=True, cache=True)
+def knn_init_dists(X, indices, euclidean):
+    n, k = indices.shape
+    dists = np.zeros((n, k), dtype=X.dtype)
+    for i in numba.prange(n):
+        for a in range(k):
+            dists[i, a] = knn_dist(X[i], X[indices[i, a]], euclidean)
+        order = np.argsort(dists[i])
+        dists[i] = dists[i][order]
+        indices[i] = indices[i][order]
+    return indices, dists
+
+
+def prepare_knn_data(X, metric, dtype=None):
+    """Returns 'X' as a dense array for the kNN searches. For the
+    correlation metric the rows are centered, and for the correlation and
+    cosine metrics they are scaled to unit norm, so that both distances
+    reduce to one minus a dot product."""
+    if sp.sparse.issparse(X):
+        X = X.toarray()
+    X = np.asarray(X, dtype=dtype)
+    if metric == 'correlation':
+        X = X - X.mean(1)[:, None]
+    if metric in ('correlation', 'cosine'):
+        norms = np.sqrt((X**2).sum(1))
+        norms[norms == 0] = 1
+        X = X / norms[:, None]
+    return X
+
+
+def refine_nearest_neighbors(X, knn_init, metric='correlation', n_iters=5,
+                             delta=0.001):
+    """Refines an existing kNN graph with a few rounds of NN-descent local
+    joins instead of building a new graph from scratch.
 
-    distance_func = dist.named_distances[metric]
+    Parameters
+    ----------
+    X - numpy.ndarray
+        The (cells x features) data in which neighbors are computed.
 
-    if metric in ("cosine", "correlation", "dice", "jaccard"):
-        angular = True
-    else:
-        angular = False
+    knn_init - numpy.ndarray, int
+        The (cells x k) neighbor indices used as the initial candidate graph,
+        e.g. the neighbors from the previous SAM iteration.
 
-    random_state = np.random.RandomState(seed=seed)
-    rng_state = random_state.randint(INT32_MIN, INT32_MAX, 3).astype(np.int64)
-
-    metric_nn_descent = make_nn_descent(
-        distance_func, tuple({}.values())
-    )
-
-    n_trees = 5 + int(round((X.shape[0]) ** 0.5 / 20.0))
-    n_iters = max(5, int(round(np.log2(X.shape[0]))))
-
-    rp_forest = make_forest(X, n_neighbors, n_trees, rng_state, angular)
-    leaf_array = rptree_leaf_array(rp_forest)
-    knn_indices, knn_dists = metric_nn_descent(
-        X,
-        n_neighbors,
-        rng_state,
-        max_candidates=60,
-        rp_tree_init=True,
-        leaf_array=leaf_array,
-        n_iters=n_iters,
-        verbose=False,
-    )
-    return knn_indices, knn_dists
+    metric - str, optional, default 'correlation'
+        One of 'correlation', 'cosine', or 'euclidean'.
+
+    n_iters - int, optional, default 5
+        The maximum number of refinement rounds.
+
+    delta - float, optional, default 0.001
+        Refinement stops once fewer than delta * cells * k neighbors are
+        updated in a round.
+
+    Returns
+    -------
+    (knn_indices, knn_dists, change), where 'change' is the fraction of
+    neighbors that differ from 'knn_init'.
+    """
+    if metric not in ('correlation', 'cosine', 'euclidean'):
+        raise ValueError('Refinement supports the correlation, cosine, and '
+                         'euclidean metrics.')
+    X = prepare_knn_data(
+        X, metric, dtype='float32' if X.dtype == np.float32 else 'float64')
+    euclidean = metric == 'euclidean'
+
+    knn_init = np.asarray(knn_init, dtype='int64')
+    n, k = knn_init.shape
+    indices, dists = knn_init_dists(X, knn_init.copy(), euclidean)
+
+    expand = np.ones(n, dtype='bool')
+    for it in range(n_iters):
+        targets = indices.flatten()
+        rev_indices = np.repeat(np.arange(n), k)[
+            np.argsort(targets, kind='stable')]
+        rev_indptr = np.append(0, np.cumsum(np.bincount(targets,
+                                                         minlength=n)))
+        indices, dists, updates = knn_refine_step(
+            X, indices, dists, rev_indptr, rev_indices, expand, euclidean)
+        expand = updates > 0
+        if updates.sum() <= delta * n * k:
+            break
+
+    rows = np.repeat(np.arange(n), k) * n
+    kept = np.isin(rows + indices.flatten(), rows + knn_init.flatten()).sum()
+    change = 1 - kept / float(n * k)
+    return indices, dists, change
 
 
 def knndist(nnma):
@@ -99,6 +211,184 @@ def affinity_calc(data, d = 'correlation', k=20):
     return nnm
 """
 
+@numba.njit(parallel=True, cache=True)
+def knn_avg_nnz(g_indptr, g_indices, x_indptr, x_indices, n_genes, n_chunks):
+    n = g_indptr.size - 1
+    chunk = (n + n_chunks - 1) // n_chunks
+    row_nnz = np.zeros(n, dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        marker = np.full(n_genes, -1, dtype=np.int64)
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            count = 0
+            for p in range(g_indptr[i], g_indptr[i + 1]):
+                j = g_indices[p]
+                for q in range(x_indptr[j], x_indptr[j + 1]):
+                    col = x_indices[q]
+                    if marker[col] != i:
+                        marker[col] = i
+                        count += 1
+            row_nnz[i] = count
+    return row_nnz
+
+
+@numba.njit(parallel=True, cache=True)
+def knn_avg_fill(g_indptr, g_indices, g_data, x_indptr, x_indices, x_data,
+                 indptr, indices, data, n_genes, n_chunks):
+    n = g_indptr.size - 1
+    chunk = (n + n_chunks - 1) // n_chunks
+    for c in numba.prange(n_chunks):
+        marker = np.full(n_genes, -1, dtype=np.int64)
+        acc = np.zeros(n_genes, dtype=data.dtype)
+        cols = np.zeros(n_genes, dtype=np.int64)
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            norm = 0.0
+            for p in range(g_indptr[i], g_indptr[i + 1]):
+                norm += g_data[p]
+            if norm == 0:
+                norm = 1.0
+            count = 0
+            for p in range(g_indptr[i], g_indptr[i + 1]):
+                j = g_indices[p]
+                w = g_data[p] / norm
+                for q in range(x_indptr[j], x_indptr[j + 1]):
+                    col = x_indices[q]
+                    if marker[col] != i:
+                        marker[col] = i
+                        cols[count] = col
+                        count += 1
+                        acc[col] = w * x_data[q]
+                    else:
+                        acc[col] += w * x_data[q]
+
+            # emit the row with sorted column indices
+            pos = indptr[i]
+            if count * 16 < n_genes:
+                sorted_cols = np.sort(cols[:count])
+                for a in range(count):
+                    indices[pos + a] = sorted_cols[a]
+                    data[pos + a] = acc[sorted_cols[a]]
+            else:
+                for col in range(n_genes):
+                    if marker[col] == i:
+                        indices[pos] = col
+                        data[pos] = acc[col]
+                        pos += 1
+
+
+def knn_avg_matrix(buffers, nnz, indptr, shape):
+    """Wraps the first 'nnz' entries of the (data, indices) 'buffers' in a
+    CSR matrix that records the buffers it was built on."""
+    D_avg = sp.sparse.csr_matrix((buffers[0][:nnz], buffers[1][:nnz], indptr),
+                                 shape=shape)
+    D_avg.has_sorted_indices = True
+    D_avg.knn_avg_buffers = buffers
+    return D_avg
+
+
+def knn_avg(nnm, X, out=None):
+    """Computes the kNN-averaged expression matrix, i.e. the row-normalized
+    nearest-neighbor graph 'nnm' times the sparse expression matrix 'X',
+    with a multi-threaded kernel that keeps the dtype of 'X' (e.g. float32)
+    and int32 indices.
+
+    Parameters
+    ----------
+    nnm - scipy.sparse
+        The (cells x cells) nearest-neighbor graph.
+
+    X - scipy.sparse or numpy.ndarray
+        The (cells x genes) expression matrix. Dense inputs fall back to a
+        regular matrix product.
+
+    out - scipy.sparse.csr_matrix, optional, default None
+        A matrix previously returned by this function that is consumed by
+        the call, like numpy's 'out' arguments: if its buffers are large
+        enough to hold the result, they are overwritten with it. Otherwise,
+        new buffers are allocated. 'out' and its arrays must not be used
+        after the call; pass a copy to keep them.
+
+    Returns
+    -------
+    The (cells x genes) averaged matrix in CSR format.
+    """
+    if not sp.sparse.issparse(X):
+        return (nnm.multiply(1 / nnm.sum(1).A)).dot(X)
+
+    nnm = sp.sparse.csr_matrix(nnm)
+    X = sp.sparse.csr_matrix(X)
+    n_chunks = min(nnm.shape[0], numba.config.NUMBA_NUM_THREADS * 4)
+    n_chunks = max(n_chunks, 1)
+
+    row_nnz = knn_avg_nnz(nnm.indptr, nnm.indices, X.indptr, X.indices,
+                          X.shape[1], n_chunks)
+    indptr = np.zeros(nnm.shape[0] + 1, dtype='int64')
+    np.cumsum(row_nnz, out=indptr[1:])
+    nnz = indptr[-1]
+    if nnz < np.iinfo(np.int32).max:
+        indptr = indptr.astype('int32')
+
+    buffers = getattr(out, 'knn_avg_buffers', None)
+    if (buffers is None or buffers[0].dtype != X.dtype or
+            buffers[0].size < nnz):
+        buffers = (np.zeros(nnz, dtype=X.dtype), np.zeros(nnz, dtype='int32'))
+    data = buffers[0][:nnz]
+    indices = buffers[1][:nnz]
+
+    knn_avg_fill(nnm.indptr, nnm.indices, nnm.data.astype(X.dtype),
+                 X.indptr, X.indices, X.data, indptr, indices, data,
+                 X.shape[1], n_chunks)
+
+    return knn_avg_matrix(buffers, nnz, indptr,
+                          (nnm.shape[0], X.shape[1]))
+
+
+def dispersion_weights(mu, var, num_norm_avg=50):
+    """Converts the per-gene means and variances of the kNN-averaged
+    expression into SAM gene weights. Returns the weights and the spatial
+    dispersions."""
+    dispersions = np.zeros(var.size)
+    dispersions[mu > 0] = var[mu > 0] / mu[mu > 0]
+    spatial_dispersions = dispersions.copy()
+
+    ma = np.sort(dispersions)[-num_norm_avg:].mean()
+    dispersions[dispersions >= ma] = ma
+
+    weights = ((dispersions / dispersions.max())**0.5).flatten()
+    return weights, spatial_dispersions
+
+
+def knn_avg_moments(nnm, X, chunk_size=5000):
+    """Computes the per-gene mean and variance of the kNN-averaged expression
+    matrix (the row-normalized 'nnm' times 'X') over chunks of rows, without
+    materializing the full product.
+
+    Returns
+    -------
+    (mean, variance), each a vector of length X.shape[1].
+    """
+    nnm = sp.sparse.csr_matrix(nnm)
+    n, m = nnm.shape[0], X.shape[1]
+    s1 = np.zeros(m)
+    s2 = np.zeros(m)
+    chunk = None
+    for start in range(0, n, chunk_size):
+        chunk = knn_avg(nnm[start:start + chunk_size], X, out=chunk)
+        if sp.sparse.issparse(chunk):
+            chunk = chunk.tocsr()
+            data = chunk.data.astype('float64')
+            s1 += np.bincount(chunk.indices, weights=data, minlength=m)
+            s2 += np.bincount(chunk.indices, weights=data**2, minlength=m)
+        else:
+            chunk = np.asarray(chunk, dtype='float64')
+            s1 += chunk.sum(0)
+            s2 += (chunk**2).sum(0)
+
+    mu = s1 / n
+    var = s2 / n - mu**2
+    var[var < 0] = 0
+    return mu, var
+
+
 def save_figures(filename, fig_IDs=None, **kwargs):
     """
     Save figures.
@@ -146,6 +436,415 @@ def save_figures(filename, fig_IDs=None, **kwargs):
     elif(savetype == 'png'):
         plt.figure(fig_IDs).savefig(filename, **kwargs)
 
+def open_text(filename):
+    """Opens a (gzipped) text file in binary mode."""
+    import gzip
+    if filename.split('.')[-1] == 'gz':
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def parse_blocks(f, parse, block_size=2**25, n_jobs=None):
+    """Splits the rest of the open binary file 'f' into blocks of about
+    'block_size' bytes on line boundaries and applies 'parse' to each block
+    in a pool of 'n_jobs' threads. Yields the results in file order, keeping
+    at most a few blocks in flight."""
+    from concurrent.futures import ThreadPoolExecutor
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending = []
+        while True:
+            block = f.read(block_size)
+            if len(block) > 0:
+                block += f.readline()
+                pending.append(pool.submit(parse, block))
+            while len(pending) > 0 and (len(pending) > 2 * n_jobs or
+                                        len(block) == 0):
+                yield pending.pop(0).result()
+            if len(block) == 0:
+                break
+
+
+def read_sparse_table(filename, sep=',', transpose=True, block_size=2**25,
+                      n_jobs=None, **kwargs):
+    """Reads a (gzipped) delimited text table of expression values into a
+    sparse matrix without building the dense table in memory.
+
+    The file is split into blocks of about 'block_size' bytes on line
+    boundaries, which are parsed by a pool of 'n_jobs' threads and converted
+    to sparse matrices right away. Values are stored as float32. Additional
+    keyword arguments are passed to 'pandas.read_csv'.
+
+    Returns
+    -------
+    (X, row_names, column_names) - the (cells x genes) CSR matrix and the
+    cell and gene names. If 'transpose' is True, the file is assumed to be
+    (genes x cells).
+    """
+    import io
+
+    columns = pd.read_csv(filename, sep=sep, index_col=0, nrows=1,
+                          **kwargs).columns
+    columns = np.array(list(columns.astype('str')))
+
+    def parse(block):
+        df = pd.read_csv(io.BytesIO(block), sep=sep, header=None,
+                         index_col=0, **kwargs)
+        return (np.array(list(df.index.astype('str'))),
+                sp.sparse.csr_matrix(df.values, dtype='float32'))
+
+    names = []
+    blocks = []
+    with open_text(filename) as f:
+        f.readline()
+        for n, X in parse_blocks(f, parse, block_size, n_jobs):
+            names.append(n)
+            blocks.append(X)
+
+    if len(blocks) > 0:
+        rows = np.concatenate(names)
+        X = sp.sparse.vstack(blocks, format='csr')
+    else:
+        rows = np.array([], dtype='str')
+        X = sp.sparse.csr_matrix((0, columns.size), dtype='float32')
+    del blocks
+
+    if transpose:
+        return X.T.tocsr(), columns, rows
+    return X, rows, columns
+
+
+def find_file(path, names):
+    """Returns the first of the files 'names' (optionally gzipped) that
+    exists in the directory 'path'."""
+    for name in names:
+        for fname in (name, name + '.gz'):
+            if os.path.isfile(os.path.join(path, fname)):
+                return os.path.join(path, fname)
+    raise FileNotFoundError(
+        errno.ENOENT, 'None of {} found'.format(', '.join(names)), path)
+
+
+@numba.njit(nogil=True, cache=True)
+def parse_mtx_block(buf, pattern):
+    """Parses the 'row col [value]' lines of a block of a Matrix Market file
+    given as a uint8 array. Returns zero-based rows, columns, and values."""
+    n_lines = 1
+    for c in buf:
+        if c == 10:
+            n_lines += 1
+    rows = np.empty(n_lines, dtype=np.int32)
+    cols = np.empty(n_lines, dtype=np.int32)
+    vals = np.ones(n_lines, dtype=np.float32)
+    fields = np.zeros(3)
+
+    L = buf.size
+    n = 0
+    i = 0
+    while i < L:
+        if buf[i] == 37:  # comment line
+            while i < L and buf[i] != 10:
+                i += 1
+            i += 1
+            continue
+
+        f = 0
+        while i < L and buf[i] != 10:
+            c = buf[i]
+            if c == 32 or c == 9 or c == 13:
+                i += 1
+                continue
+            neg = c == 45
+            if c == 45 or c == 43:
+                i += 1
+            m = 0.0
+            e = 0
+            while i < L and buf[i] >= 48 and buf[i] <= 57:
+                m = m * 10 + (buf[i] - 48)
+                i += 1
+            if i < L and buf[i] == 46:
+                i += 1
+                while i < L and buf[i] >= 48 and buf[i] <= 57:
+                    m = m * 10 + (buf[i] - 48)
+                    e -= 1
+                    i += 1
+            if i < L and (buf[i] == 101 or buf[i] == 69):
+                i += 1
+                eneg = i < L and buf[i] == 45
+                if i < L and (buf[i] == 45 or buf[i] == 43):
+                    i += 1
+                ee = 0
+                while i < L and buf[i] >= 48 and buf[i] <= 57:
+                    ee = ee * 10 + (buf[i] - 48)
+                    i += 1
+                e += -ee if eneg else ee
+            x = m * 10.0**e
+            if f < 3:
+                fields[f] = -x if neg else x
+            f += 1
+        i += 1
+
+        if f >= 2:
+            rows[n] = int(fields[0]) - 1
+            cols[n] = int(fields[1]) - 1
+            if not pattern:
+                vals[n] = fields[2]
+            n += 1
+    return rows[:n], cols[:n], vals[:n]
+
+
+def read_mtx(path, transpose=True, block_size=2**25, n_jobs=None):
+    """Reads a Matrix Market file and its barcodes and features (or genes)
+    files, as written by 10x Cell Ranger, into a sparse matrix.
+
+    'path' is either the directory containing 'matrix.mtx(.gz)',
+    'barcodes.tsv(.gz)', and 'features.tsv(.gz)' / 'genes.tsv(.gz)', or the
+    path to the Matrix Market file itself. The coordinate triplets are parsed
+    in blocks by a pool of 'n_jobs' threads (the numba parser releases the
+    GIL) and assembled directly into CSR format. Gene symbols (the second
+    column of the features file, if present) are used as gene names. The
+    entries of symmetric and skew-symmetric matrices are mirrored.
+
+    Returns
+    -------
+    (X, cell_names, gene_names) - the (cells x genes) float32 CSR matrix and
+    the cell and gene names. If 'transpose' is True, the matrix is assumed to
+    be (genes x cells).
+    """
+    if os.path.isdir(path):
+        fmtx = find_file(path, ['matrix.mtx'])
+    else:
+        fmtx, path = path, os.path.dirname(path)
+
+    with open_text(fmtx) as f:
+        header = f.readline().decode().lower().split()
+        if (len(header) < 4 or header[0] != '%%matrixmarket' or
+                header[2] != 'coordinate'):
+            raise ValueError(
+                '{} is not a Matrix Market coordinate file.'.format(fmtx))
+        if header[3] not in ('real', 'integer', 'pattern'):
+            raise ValueError('{} has unsupported {} entries.'.format(
+                fmtx, header[3]))
+        symmetry = header[4] if len(header) > 4 else 'general'
+        if symmetry not in ('general', 'symmetric', 'skew-symmetric'):
+            raise ValueError('{} has an unsupported {} structure.'.format(
+                fmtx, symmetry))
+        pattern = header[3] == 'pattern'
+        line = f.readline()
+        while line.startswith(b'%'):
+            line = f.readline()
+        nrows, ncols, nnz = [int(x) for x in line.split()]
+
+        def parse(block):
+            return parse_mtx_block(np.frombuffer(block, dtype=np.uint8),
+                                   pattern)
+
+        triplets = list(parse_blocks(f, parse, block_size, n_jobs))
+
+    rows, cols, data = [np.concatenate(x) if len(triplets) > 0 else
+                        np.array([], dtype=dt) for x, dt in
+                        zip(zip(*triplets), ['int32', 'int32', 'float32'])]
+    del triplets
+    if rows.size != nnz:
+        raise ValueError('Expected {} entries in {}, found {}.'.format(
+            nnz, fmtx, rows.size))
+    if symmetry != 'general':
+        # only one triangle is stored
+        off = rows != cols
+        sign = -1 if symmetry == 'skew-symmetric' else 1
+        rows, cols = (np.concatenate((rows, cols[off])),
+                      np.concatenate((cols, rows[off])))
+        data = np.concatenate((data, sign * data[off]))
+
+    if transpose:
+        X = sp.sparse.csr_matrix((data, (cols, rows)), shape=(ncols, nrows))
+    else:
+        X = sp.sparse.csr_matrix((data, (rows, cols)), shape=(nrows, ncols))
+    X.sum_duplicates()
+
+    barcodes = pd.read_csv(find_file(path, ['barcodes.tsv']), sep='\t',
+                           header=None, dtype='str')
+    features = pd.read_csv(find_file(path, ['features.tsv', 'genes.tsv']),
+                           sep='\t', header=None, dtype='str')
+    cell_names = np.array(list(barcodes.iloc[:, 0]))
+    gene_names = np.array(list(features.iloc[:, min(1, features.shape[1] - 1)]))
+
+    if X.shape != (cell_names.size, gene_names.size):
+        raise ValueError(
+            'The matrix dimensions {} do not match the number of barcodes '
+            '({}) and features ({}).'.format(X.shape, cell_names.size,
+                                             gene_names.size))
+    return X, cell_names, gene_names
+
+
+@numba.njit(parallel=True, cache=True)
+def normalize_kernel(indptr, indices, data, row_scale, col_scale, norm, div,
+                     min_expression, n_genes, n_chunks):
+    n = indptr.size - 1
+    chunk = (n + n_chunks - 1) // n_chunks
+    out = np.empty(data.size, dtype=np.float32)
+    counts = np.zeros((n_chunks, n_genes), dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            for p in range(indptr[i], indptr[i + 1]):
+                j = indices[p]
+                x = data[p] * row_scale[i] * col_scale[j] / div
+                if norm == 1:
+                    x = np.log2(x + 1)
+                elif norm == 2:
+                    x = np.sqrt(x) + np.sqrt(x + 1) - 1
+                elif norm == 3:
+                    x = np.arcsinh(x)
+                if x <= min_expression:
+                    x = 0
+                out[p] = x
+                counts[c, j] += 1
+    return out, counts.sum(0)
+
+
+def normalize_sparse(X, row_scale=None, col_scale=None, norm='log', div=1,
+                     min_expression=1):
+    """Scales, transforms ('log', 'ftt', 'asin', or None), and thresholds the
+    expression values of a CSR matrix in a single parallel pass.
+
+    Each value x in row i and column j becomes
+    norm(x * row_scale[i] * col_scale[j] / div), and values less than or equal
+    to 'min_expression' are set to zero (but not removed).
+
+    Returns
+    -------
+    (X, counts) - the float32 CSR matrix with the sparsity pattern of 'X' and
+    the number of stored entries in each column.
+    """
+    X = sp.sparse.csr_matrix(X)
+    n_cells, n_genes = X.shape
+    row_scale = (np.ones(n_cells) if row_scale is None else
+                 np.asarray(row_scale, dtype='float64'))
+    col_scale = (np.ones(n_genes) if col_scale is None else
+                 np.asarray(col_scale, dtype='float64'))
+    code = {'log': 1, 'ftt': 2, 'asin': 3}.get(
+        norm.lower() if norm is not None else None, 0)
+    n_chunks = max(1, min(n_cells, 4 * numba.get_num_threads()))
+    data, counts = normalize_kernel(
+        X.indptr, X.indices, X.data, row_scale, col_scale, code, float(div),
+        float(min_expression), n_genes, n_chunks)
+    X = sp.sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape)
+    return X, counts
+
+
+@numba.njit(parallel=True, cache=True)
+def pearson_residual_kernel(indptr, indices, data, ni, pj, clip, n_chunks):
+    n = indptr.size - 1
+    chunk = (n + n_chunks - 1) // n_chunks
+    out = np.empty(data.size, dtype=np.float32)
+    for c in numba.prange(n_chunks):
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            for p in range(indptr[i], indptr[i + 1]):
+                mu = ni[i] * pj[indices[p]]
+                r = (data[p] - mu) / np.sqrt(mu - mu * mu / ni[i])
+                if clip > 0:
+                    r = min(max(r, -clip), clip)
+                out[p] = r
+    return out
+
+
+def pearson_residuals(X, ni=None, pj=None, clip=None):
+    """Computes the Pearson residuals of the nonzero UMI counts of a CSR
+    matrix under a multinomial model in a single parallel pass.
+
+    The expected count of gene j in cell i is mu = ni[i] * pj[j] with
+    variance mu - mu^2 / ni[i], where 'ni' are the total counts per cell and
+    'pj' the fraction of all counts per gene. Both are computed from 'X' if
+    not provided (e.g. when 'X' is a chunk of cells). Residuals are clipped
+    to [-clip, clip] if 'clip' is not None.
+
+    Returns
+    -------
+    (R, ni, pj) - the float32 CSR matrix of residuals with the sparsity
+    pattern of 'X', and the total counts and gene fractions.
+    """
+    X = sp.sparse.csr_matrix(X)
+    if ni is None:
+        ni = np.asarray(X.sum(1, dtype='float64')).flatten()
+    if pj is None:
+        pj = np.asarray(X.sum(0, dtype='float64')).flatten()
+        pj = pj / pj.sum()
+    n_chunks = max(1, min(X.shape[0], 4 * numba.get_num_threads()))
+    data = pearson_residual_kernel(
+        X.indptr, X.indices, X.data, np.asarray(ni, dtype='float64'),
+        np.asarray(pj, dtype='float64'),
+        0. if clip is None else float(clip), n_chunks)
+    R = sp.sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape)
+    return R, ni, pj
+
+
+def dense_pearson_residuals(R, ni, pj, clip=None):
+    """Expands the sparse Pearson residuals 'R' of a subset of genes into a
+    dense float32 array, filling in the residuals -sqrt(ni * pj / (1 - pj))
+    of the zero counts. 'R' must have the sparsity pattern of the counts,
+    i.e. store the residuals that are exactly zero (see 'filter_sparse')."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = -np.sqrt(np.outer(ni, pj / (1 - pj))).astype('float32')
+    if clip is not None:
+        np.clip(out, -clip, clip, out=out)
+    R = sp.sparse.coo_matrix(R)
+    out[R.row, R.col] = R.data
+    return out
+
+
+@numba.njit(parallel=True, cache=True)
+def filter_kernel(indptr, indices, data, mask, keep_zeros):
+    n = indptr.size - 1
+    row_nnz = np.zeros(n + 1, dtype=np.int64)
+    for i in numba.prange(n):
+        count = 0
+        for p in range(indptr[i], indptr[i + 1]):
+            if (keep_zeros or data[p] != 0) and mask[indices[p]]:
+                count += 1
+        row_nnz[i + 1] = count
+    new_indptr = np.cumsum(row_nnz)
+    new_indices = np.empty(new_indptr[n], dtype=indices.dtype)
+    new_data = np.empty(new_indptr[n], dtype=data.dtype)
+    for i in numba.prange(n):
+        q = new_indptr[i]
+        for p in range(indptr[i], indptr[i + 1]):
+            if (keep_zeros or data[p] != 0) and mask[indices[p]]:
+                new_indices[q] = indices[p]
+                new_data[q] = data[p]
+                q += 1
+    return new_indptr, new_indices, new_data
+
+
+def filter_sparse(X, mask, keep_zeros=False):
+    """Removes the zeros (unless 'keep_zeros' is True) and the entries in the
+    columns not selected by the boolean 'mask' from a CSR matrix in a single
+    pass. The shape of the matrix is unchanged."""
+    indptr, indices, data = filter_kernel(X.indptr, X.indices, X.data,
+                                          np.asarray(mask, dtype='bool'),
+                                          keep_zeros)
+    return sp.sparse.csr_matrix((data, indices, indptr), shape=X.shape)
+
+
+def iter_row_chunks(X, chunk_size=10000, mask=None):
+    """Yields consecutive row chunks of a (possibly backed) matrix as sorted
+    float32 CSR matrices, keeping only the rows selected by 'mask'."""
+    for start in range(0, X.shape[0], chunk_size):
+        stop = min(start + chunk_size, X.shape[0])
+        if mask is not None and not mask[start:stop].any():
+            continue
+        D = X[start:stop]
+        if sp.sparse.issparse(D):
+            D = sp.sparse.csr_matrix(D, dtype='float32')
+        else:
+            D = sp.sparse.csr_matrix(np.asarray(D), dtype='float32')
+        if mask is not None:
+            D = D[mask[start:stop]]
+        D.sort_indices()
+        yield D
+
+
 def weighted_PCA(mat, do_weight=True, npcs=None, solver='auto'):
     #mat = (mat - np.mean(mat, axis=0))
     if(do_weight):
@@ -175,30 +874,125 @@ def weighted_PCA(mat, do_weight=True, npcs=None, solver='auto'):
     return reduced_weighted, pca
 
 
-def weighted_sparse_PCA(mat, do_weight=True, npcs=None):
+def centered_operator(mat, mu):
+    """Wraps a (sparse) matrix as a LinearOperator that implicitly subtracts
+    the column means 'mu' without densifying the matrix."""
+    from scipy.sparse.linalg import LinearOperator
+    mu = np.asarray(mu, dtype=mat.dtype).flatten()
 
-    if(do_weight):
-        if(min(mat.shape) >= 10000 and npcs is None):
-            print(
-                "More than 10,000 cells. Running with 'npcs' set to < 1000 is"
-                " recommended.")
+    def matmat(V):
+        V = V.reshape((mat.shape[1], -1))
+        return np.asarray(mat.dot(V)) - mu.dot(V)[None, :]
 
-        if(npcs is None):
-            ncom = min(mat.shape)
-        else:
-            ncom = min((min(mat.shape), npcs))
+    def rmatmat(U):
+        U = U.reshape((mat.shape[0], -1))
+        return np.asarray(mat.T.dot(U)) - mu[:, None] * U.sum(0)[None, :]
 
-        pca = TruncatedSVD(n_components=ncom)
-        reduced = pca.fit_transform(mat)
+    return LinearOperator(
+        mat.shape, matvec=lambda v: matmat(v).flatten(),
+        rmatvec=lambda u: rmatmat(u).flatten(), matmat=matmat,
+        rmatmat=rmatmat, dtype=mat.dtype)
+
+
+def randomized_svd(A, n_components, n_oversamples=10, n_iter=4, seed=0,
+                   init=None, tol=None, return_n_iter=False):
+    """Randomized truncated SVD (Halko et al.) of a dense/sparse matrix or
+    LinearOperator 'A'. Returns (U, s, Vt) with deterministic signs.
+
+    'init' is an optional (features x l) block, e.g. the principal axes
+    from a previous decomposition, that seeds the range finder. If 'tol' is
+    set, power iterations stop early once the variance-weighted rotation of
+    the right singular subspace falls below 'tol'.
+    """
+    n, m = A.shape
+    n_random = min(n_components + n_oversamples, min(n, m))
+    random_state = np.random.RandomState(seed=seed)
+
+    omega = random_state.normal(size=(m, n_random)).astype(A.dtype)
+    V_old = None
+    if init is not None:
+        init = np.asarray(init)[:, :n_random]
+        omega[:, :init.shape[1]] = init
+        V_old = np.linalg.qr(init)[0].T
+
+    Q = np.linalg.qr(A @ omega)[0]
+    for i in range(n_iter + 1):
+        B = (A.T @ Q).T
+        Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+        if i == n_iter:
+            break
+        if tol is not None and V_old is not None:
+            w = s[:n_components]**2
+            captured = ((V_old @ Vt[:n_components].T)**2).sum(0)
+            rotation = (w * (1 - np.clip(captured, 0, 1))).sum() / w.sum()
+            if rotation < tol:
+                break
+        V_old = Vt[:n_components]
+        Q = np.linalg.qr(A @ np.linalg.qr(B.T)[0])[0]
+
+    U = Q.dot(Ub)[:, :n_components]
+    s = s[:n_components]
+    Vt = Vt[:n_components]
+
+    signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+    U = U * signs[None, :]
+    Vt = Vt * signs[:, None]
+    if return_n_iter:
+        return U, s, Vt, i
+    return U, s, Vt
+
+
+def weighted_sparse_PCA(mat, do_weight=True, npcs=None, seed=0, init=None,
+                        tol=None, n_iter=4):
+    """PCA of a sparse (cells x genes) matrix without densifying it.
+
+    The matrix is mean-centered implicitly through a LinearOperator that
+    feeds a randomized SVD. Returns the (weighted) principal components and
+    a fitted sklearn PCA object compatible with 'transform_wPCA'. 'init',
+    'tol' and 'n_iter' are passed to 'randomized_svd' to warm-start the
+    decomposition.
+    """
+    if not sp.sparse.issparse(mat):
+        mat = sp.sparse.csr_matrix(mat)
+    mat = mat.tocsr()
+
+    if(min(mat.shape) >= 10000 and npcs is None):
+        print(
+            "More than 10,000 cells. Running with 'npcs' set to < 1000 is"
+            " recommended.")
+
+    if(npcs is None):
+        ncom = min(mat.shape)
+    else:
+        ncom = min((min(mat.shape), npcs))
+    if not do_weight:
+        ncom = max(ncom, 2)
+
+    mu, var = sf.mean_variance_axis(mat, axis=0)
+    centered = centered_operator(mat, mu)
+    U, s, Vt, n_iter = randomized_svd(centered, ncom, seed=seed, init=init,
+                                      tol=tol, n_iter=n_iter,
+                                      return_n_iter=True)
+    reduced = centered @ Vt.T
+
+    pca = PCA(n_components=ncom)
+    pca.components_ = Vt
+    pca.mean_ = mu
+    pca.singular_values_ = s
+    pca.explained_variance_ = s**2 / max(mat.shape[0] - 1, 1)
+    total_var = var.sum() * mat.shape[0] / max(mat.shape[0] - 1, 1)
+    pca.explained_variance_ratio_ = pca.explained_variance_ / total_var
+    pca.noise_variance_ = 0.
+    pca.n_components_ = ncom
+    pca.n_iter_ = n_iter
+    pca.n_samples_, pca.n_features_in_ = mat.shape
+
+    if(do_weight):
         scaled_eigenvalues = reduced.var(0)
         scaled_eigenvalues = scaled_eigenvalues / scaled_eigenvalues.max()
         reduced_weighted = reduced * scaled_eigenvalues[None, :]**0.5
     else:
-        pca = TruncatedSVD(n_components=npcs, svd_solver='auto')
-        reduced = pca.fit_transform(mat)
-        if reduced.shape[1] == 1:
-            pca = TruncatedSVD(n_components=2, svd_solver='auto')
-            reduced = pca.fit_transform(mat)
         reduced_weighted = reduced
 
     return reduced_weighted, pca
@@ -296,6 +1090,328 @@ def create_folder(path):
             raise
 
 
+def write_project(path, attrs, skip=()):
+    """Writes a dictionary of attributes to a project directory.
+
+    Numeric arrays, the components of sparse matrices, and numeric columns of
+    data frames are stored as separate '.npy' files so that 'read_project'
+    can memory-map them. AnnData objects, dictionaries, and data frames are
+    traversed recursively. Anything else is pickled. Arrays shared between
+    several attributes (e.g. 'X' and the 'X_disp' layer) are stored once. A
+    'manifest.json' file describing the structure is written last. Entries
+    whose key paths are listed in 'skip' (as tuples) are not saved.
+
+    The project is written to a temporary directory that then replaces
+    'path', so no files of a previous project at 'path' are left behind.
+    Memory-mapped arrays of a previously loaded project remain valid.
+    """
+    import json
+    import shutil
+    path = os.path.normpath(path)
+    if os.path.exists(path) and not (os.path.isdir(path) and (
+            len(os.listdir(path)) == 0 or
+            os.path.isfile(os.path.join(path, 'manifest.json')))):
+        raise ValueError('{} exists and is not a project directory.'.format(
+            path))
+    parent = os.path.dirname(os.path.abspath(path))
+    create_folder(parent)
+    target = path
+    path = tempfile.mkdtemp(dir=parent,
+                            prefix='.' + os.path.basename(target) + '.')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(path, 0o777 & ~umask)
+    saved = {}
+    files = set()
+
+    def write_file(keys, ext, writer):
+        name = '.'.join(re.sub('[^A-Za-z0-9_-]', '_', str(k)) for k in keys)
+        fname = name + ext
+        i = 1
+        while fname in files:
+            fname = '{}_{}{}'.format(name, i, ext)
+            i += 1
+        files.add(fname)
+        with open(os.path.join(path, fname), 'wb') as f:
+            writer(f)
+        return fname
+
+    def write_array(keys, a):
+        return write_file(keys, '.npy',
+                          lambda f: np.save(f, a, allow_pickle=False))
+
+    def write_pickle(keys, obj):
+        return write_file(keys, '.p', lambda f: pickle.dump(obj, f))
+
+    def write(keys, obj):
+        if keys in skip:
+            return None
+        if id(obj) in saved and saved[id(obj)][0] is obj:
+            return saved[id(obj)][1]
+
+        if obj is None or type(obj) in (bool, int, float, str):
+            entry = {'type': 'value', 'value': obj}
+        elif isinstance(obj, AnnData) and obj.isbacked:
+            entry = {'type': 'backed_anndata', 'filename': str(obj.filename)}
+        elif isinstance(obj, AnnData):
+            entry = {'type': 'anndata', 'X': write(keys + ('X',), obj.X)}
+            for key in ('obs', 'var', 'layers', 'obsm', 'varm', 'obsp',
+                        'varp', 'uns'):
+                if key in ('obs', 'var', 'uns'):
+                    value = getattr(obj, key)
+                else:
+                    value = dict(getattr(obj, key))
+                entry[key] = write(keys + (key,), value)
+        elif sp.sparse.issparse(obj) and obj.format in ('csr', 'csc'):
+            entry = {'type': 'sparse', 'format': obj.format,
+                     'shape': list(obj.shape),
+                     'data': write_array(keys + ('data',), obj.data),
+                     'indices': write_array(keys + ('indices',), obj.indices),
+                     'indptr': write_array(keys + ('indptr',), obj.indptr)}
+        elif isinstance(obj, np.ndarray) and obj.dtype.kind in 'biufc':
+            entry = {'type': 'array', 'file': write_array(keys, obj)}
+        elif isinstance(obj, pd.DataFrame):
+            numeric = [i for i in range(obj.shape[1])
+                       if isinstance(obj.iloc[:, i].values, np.ndarray) and
+                       obj.iloc[:, i].dtype.kind in 'biufc']
+            other = [i for i in range(obj.shape[1]) if i not in numeric]
+            entry = {'type': 'frame', 'columns': [
+                [i, write(keys + (obj.columns[i],), obj.iloc[:, i].values)]
+                for i in numeric],
+                'file': write_pickle(keys, (obj.iloc[:, other],
+                                            list(obj.columns[numeric])))}
+        elif isinstance(obj, NNIndex):
+            # arrays of the index are memory-mapped like all other arrays
+            entry = {'type': 'nnindex', 'state': write(keys, obj.__dict__)}
+        elif isinstance(obj, dict) and all(
+                isinstance(k, str) for k in obj.keys()):
+            entry = {'type': 'dict', 'items': {
+                k: write(keys + (k,), v) for k, v in obj.items()
+                if keys + (k,) not in skip}}
+        else:
+            entry = {'type': 'pickle', 'file': write_pickle(keys, obj)}
+
+        if isinstance(obj, np.ndarray) or sp.sparse.issparse(obj):
+            saved[id(obj)] = (obj, entry)
+        return entry
+
+    try:
+        manifest = {'version': 1, 'attributes': {
+            k: write((k,), v) for k, v in attrs.items() if (k,) not in skip}}
+        write_file(('manifest',), '.json', lambda f: f.write(
+            json.dumps(manifest, indent=1).encode()))
+    except BaseException:
+        shutil.rmtree(path)
+        raise
+
+    if os.path.exists(target):
+        old = path + '.old'
+        os.rename(target, old)
+        os.rename(path, target)
+        shutil.rmtree(old)
+    else:
+        os.rename(path, target)
+
+
+def read_project(path):
+    """Reads the attributes of a project directory written by
+    'write_project'. Arrays are memory-mapped copy-on-write, so they are only
+    read from disk when accessed and can be modified in memory without
+    changing the files."""
+    import json
+    import anndata
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    loaded = {}
+
+    def read_array(fname):
+        return np.load(os.path.join(path, fname), mmap_mode='c')
+
+    def read(entry):
+        if entry is None:
+            return None
+        if entry['type'] == 'value':
+            return entry['value']
+        key = json.dumps(entry, sort_keys=True)
+        if key in loaded:
+            return loaded[key]
+
+        t = entry['type']
+        if t == 'backed_anndata':
+            obj = anndata.read_h5ad(entry['filename'], backed='r')
+        elif t == 'anndata':
+            parts = {k: read(entry[k]) for k in (
+                'X', 'obs', 'var', 'layers', 'obsm', 'varm', 'obsp', 'varp')}
+            obj = AnnData(**{k: v for k, v in parts.items() if v is not None})
+            # assigned after construction so that AnnData does not move the
+            # nearest-neighbor graphs out of 'uns'
+            obj.uns = read(entry['uns'])
+        elif t == 'sparse':
+            cls = (sp.sparse.csr_matrix if entry['format'] == 'csr' else
+                   sp.sparse.csc_matrix)
+            obj = cls((read_array(entry['data']),
+                       read_array(entry['indices']),
+                       read_array(entry['indptr'])),
+                      shape=tuple(entry['shape']), copy=False)
+        elif t == 'array':
+            obj = read_array(entry['file'])
+        elif t == 'frame':
+            with open(os.path.join(path, entry['file']), 'rb') as f:
+                obj, names = pickle.load(f)
+            for (i, column), name in zip(entry['columns'], names):
+                obj.insert(i, name, read(column))
+        elif t == 'dict':
+            obj = {k: read(v) for k, v in entry['items'].items()}
+        elif t == 'nnindex':
+            obj = NNIndex.__new__(NNIndex)
+            obj.__dict__.update(read(entry['state']))
+        else:
+            with open(os.path.join(path, entry['file']), 'rb') as f:
+                obj = pickle.load(f)
+
+        if t in ('array', 'sparse'):
+            loaded[key] = obj
+        return obj
+
+    return {k: read(v) for k, v in manifest['attributes'].items()}
+
+
+def save_checkpoint(fname, i, W, nnm, err, state=None):
+    """Writes a SAM.run checkpoint (iteration number, gene weights, nearest
+    neighbor graph, and convergence error) to 'fname'. 'state' is an
+    optional dict of further run state (numbers or numeric arrays, e.g. the
+    position in the iteration schedule), stored as plain arrays.
+
+    The checkpoint is written to a temporary file that atomically replaces
+    'fname', so an interrupted write never corrupts an existing checkpoint.
+    """
+    nnm = sp.sparse.csr_matrix(nnm)
+    extra = {}
+    if state is not None:
+        extra = {'state_' + key: np.asarray(value)
+                 for key, value in state.items()}
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, iteration=i, W=W, err=err, indptr=nnm.indptr,
+                     indices=nnm.indices, data=nnm.data,
+                     shape=np.array(nnm.shape), **extra)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_checkpoint(fname):
+    """Loads a checkpoint written by 'save_checkpoint'.
+
+    Returns
+    -------
+    (iteration, W, nnm, err, state), where 'state' is the dict of arrays
+    passed to 'save_checkpoint' (empty if the checkpoint was written without
+    one).
+    """
+    with np.load(fname, allow_pickle=False) as f:
+        nnm = sp.sparse.csr_matrix(
+            (f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        state = {key[6:]: f[key] for key in f.files
+                 if key.startswith('state_')}
+        return int(f['iteration']), f['W'], nnm, float(f['err']), state
+
+
+def share_arrays(arrays):
+    """Copies numpy arrays into shared memory blocks.
+
+    Returns
+    -------
+    (blocks, specs) - the SharedMemory blocks, which the caller must close
+    and unlink, and the (name, shape, dtype) descriptors used by
+    'attach_arrays' to map the arrays in other processes without copying.
+    """
+    from multiprocessing import shared_memory
+    blocks = []
+    specs = []
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        specs.append((shm.name, a.shape, a.dtype.str))
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    """Maps arrays created by 'share_arrays' into the current process."""
+    from multiprocessing import shared_memory
+    blocks = []
+    arrays = []
+    for name, shape, dtype in specs:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13; worker processes share the resource tracker of
+            # the parent, which unlinks the block
+            shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return blocks, arrays
+
+
+def limit_threads(n_threads):
+    """Caps the number of BLAS/OpenMP and numba threads in this process."""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=n_threads)
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def ensemble_worker(args):
+    """Runs SAM on shared-memory expression data with a given random seed.
+    Used by 'SAM.run_ensemble'. The preprocessing arguments and the obs and
+    var columns that 'run' reads are passed along with the data."""
+    from SAM import SAM
+    from anndata import AnnData
+    specs, shape, seed, run_kwargs, preprocess_args, obs, var = args
+
+    blocks, arrays = attach_arrays(specs)
+    X = sp.sparse.csr_matrix(tuple(arrays[:3]), shape=shape, copy=False)
+    if len(arrays) > 3:
+        X_disp = sp.sparse.csr_matrix(tuple(arrays[3:]), shape=shape,
+                                      copy=False)
+    else:
+        X_disp = X
+
+    sam = SAM()
+    sam.adata = AnnData(X=X)
+    sam.adata.layers['X_disp'] = X_disp
+    for key, value in obs.items():
+        sam.adata.obs[key] = value
+    for key, value in var.items():
+        sam.adata.var[key] = value
+    sam.preprocess_args = preprocess_args
+
+    np.random.seed(seed)
+    sam.run(**run_kwargs)
+
+    result = {'seed': seed,
+              'weights': sam.adata.var['weights'].values.copy(),
+              'connectivities': sam.adata.uns['neighbors']['connectivities'],
+              'X_pca': np.array(sam.adata.obsm['X_pca'])}
+    for key in ('X_umap', 'X_tsne'):
+        if key in sam.adata.obsm.keys():
+            result[key] = np.array(sam.adata.obsm[key])
+
+    del sam, X, X_disp, arrays
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+    return result
+
+
 def convert_annotations(A):
     x = np.unique(A)
     y = np.zeros(A.size)
@@ -306,28 +1422,568 @@ def convert_annotations(A):
 
     return y.astype('int')
 
-def calc_nnm(g_weighted,k,distance):
-    numcells=g_weighted.shape[0]
-    if g_weighted.shape[0] > 8000:
-        try:
-            nnm, dists = nearest_neighbors(
-                g_weighted, n_neighbors=k, metric=distance)
-        except SystemError:
-            print('Adding noise...')
-            g_weighted = g_weighted + np.random.normal(loc=0,scale=g_weighted.flatten().std()/4,size=g_weighted.shape)
-            nnm, dists = nearest_neighbors(
-                g_weighted, n_neighbors=k, metric=distance)
-        EDM = sp.sparse.coo_matrix((numcells, numcells), dtype='i').tolil()
-        EDM[np.tile(np.arange(nnm.shape[0])[:, None],
-                    (1, nnm.shape[1])).flatten(), nnm.flatten()] = 1
-        EDM = EDM.tocsr()
+def knn_search(g_weighted, k, distance, knn_init=None, method='auto',
+               return_index=False):
+    """Returns the (cells x k) nearest-neighbor indices and distances of
+    each cell, sorted by distance with each cell listed first.
+
+    'method' selects the kNN backend ('exact', 'sharded', 'nndescent',
+    'hnsw', or any other key of KNN_METHODS). If 'auto', the backend is chosen by
+    'choose_knn_method'. With an approximate backend, 'knn_init' (e.g. the
+    previous SAM iteration's neighbors) is refined with NN-descent instead
+    of building a new index. If 'return_index' is True, the 'NNIndex' built
+    for the search (None if the graph was refined) is returned as well."""
+    if sp.sparse.issparse(g_weighted):
+        g_weighted = g_weighted.toarray()
+    if method == 'auto':
+        method = choose_knn_method(*g_weighted.shape)
+
+    if (method not in EXACT_KNN_METHODS and knn_init is not None and
+            knn_init.shape[1] == k and
+            distance in ('correlation', 'cosine', 'euclidean')):
+        nnm, dists, change = refine_nearest_neighbors(
+            g_weighted, knn_init, metric=distance)
+        index = None
+    else:
+        index = NNIndex(g_weighted, metric=distance, n_neighbors=k,
+                        method=method)
+        nnm, dists = index.neighbor_graph()
+    if return_index:
+        return nnm, dists, index
+    return nnm, dists
+
+
+def calc_nnm(g_weighted,k,distance,knn_init=None,method='auto'):
+    nnm, dists = knn_search(g_weighted, k, distance, knn_init=knn_init,
+                            method=method)
+    return gen_sparse_knn(nnm)
+
+
+def knn_recall(X, nnm, metric='correlation', n_sample=1000, seed=0):
+    """Returns the fraction of the exact k nearest neighbors of a random
+    sample of 'n_sample' rows of 'X' that are found in the nearest-neighbor
+    graph 'nnm' (a sparse matrix with k neighbors per row)."""
+    nnm = sp.sparse.csr_matrix(nnm)
+    n = X.shape[0]
+    k = int(np.diff(nnm.indptr).max())
+    sample = np.sort(np.random.RandomState(seed).choice(
+        n, min(n_sample, n), replace=False))
+    exact = knn_blocked(X[sample], k, metric=metric, Y=X)[0]
+    exact = gen_sparse_knn(exact, shape=(sample.size, n))
+    return nnm[sample].multiply(exact).nnz / float(exact.nnz)
+
+def knn_blocked(X, k, metric='correlation', block_size=None, Y=None):
+    """Exact k-nearest neighbors computed over tiles of rows.
+
+    Only a (block_size x cells) distance block is held in memory at a time
+    and the top-k neighbors of each row are selected with argpartition. Each
+    cell is its own nearest neighbor, consistent with 'dist_to_nn'.
+
+    Parameters
+    ----------
+    X - numpy.ndarray
+        The (cells x features) data.
+
+    k - int
+        The number of nearest neighbors (including the cell itself).
+
+    metric - str, optional, default 'correlation'
+        'correlation', 'cosine', 'euclidean', or any metric supported by
+        scipy's 'cdist'.
+
+    block_size - int, optional, default None
+        The number of rows per tile. If None, tiles are sized to hold about
+        2^25 distances.
+
+    Y - numpy.ndarray, optional, default None
+        If provided, the neighbors of the rows of 'X' are searched among the
+        rows of 'Y' (which need not include the cells themselves).
+
+    Returns
+    -------
+    (knn_indices, knn_dists), each (cells x k) and sorted by distance.
+    """
+    query = Y is not None
+    X = prepare_knn_data(X, metric)
+    Y = prepare_knn_data(Y, metric) if query else X
+    n = X.shape[0]
+    m = Y.shape[0]
+    k = min(k, m)
+    if metric == 'euclidean':
+        sq_norms = (Y**2).sum(1)
+
+    if block_size is None:
+        block_size = max(1, min(n, 2**25 // m))
+
+    knn_indices = np.zeros((n, k), dtype='int64')
+    knn_dists = np.zeros((n, k), dtype=X.dtype)
+    for start in range(0, n, block_size):
+        end = min(n, start + block_size)
+        if metric in ('correlation', 'cosine'):
+            d = 1 - X[start:end].dot(Y.T)
+        elif metric == 'euclidean':
+            d = ((X[start:end]**2).sum(1)[:, None] + sq_norms[None, :] -
+                 2 * X[start:end].dot(Y.T))
+            d[d < 0] = 0
+        else:
+            d = sp.spatial.distance.cdist(X[start:end], Y, metric=metric)
+
+        rows = np.arange(end - start)[:, None]
+        if not query:
+            d[rows.flatten(), rows.flatten() + start] = -np.inf
+        if k < m:
+            idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.tile(np.arange(m)[None, :], (end - start, 1))
+        dd = d[rows, idx]
+        order = np.argsort(dd, axis=1)
+        idx = idx[rows, order]
+        dd = dd[rows, order]
+        if not query:
+            dd[:, 0] = 0
+        if metric == 'euclidean':
+            dd = np.sqrt(dd)
+        elif query:
+            dd[dd < 0] = 0
+
+        knn_indices[start:end] = idx
+        knn_dists[start:end] = dd
+    return knn_indices, knn_dists
+
+
+def knn_shard(Xq, Xr, sq_norms, q_start, r_start, k, metric, self_search):
+    """Returns the top-k (indices, distances) of the query rows 'Xq' among
+    the reference rows 'Xr' (prepared as in 'knn_sharded'), with indices
+    offset by 'r_start'. If 'self_search', the queries and references are
+    rows of the same matrix and each row gets a distance of -inf to
+    itself."""
+    if metric == 'euclidean':
+        d = ((Xq**2).sum(1)[:, None] + sq_norms[None, :] - 2 * Xq.dot(Xr.T))
+        d[d < 0] = 0
+    else:
+        d = 1 - Xq.dot(Xr.T)
+
+    lo = max(q_start, r_start)
+    hi = min(q_start + Xq.shape[0], r_start + Xr.shape[0])
+    if self_search and lo < hi:
+        diag = np.arange(lo, hi)
+        d[diag - q_start, diag - r_start] = -np.inf
+
+    k = min(k, d.shape[1])
+    rows = np.arange(d.shape[0])[:, None]
+    idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+    return idx + r_start, d[rows, idx]
+
+
+def knn_shard_init(specs, n_threads):
+    """Maps the shared arrays of 'knn_sharded' into a worker process."""
+    global SHARD_ARRAYS
+    limit_threads(n_threads)
+    SHARD_ARRAYS = attach_arrays(specs)
+
+
+def knn_shard_worker(task):
+    """Processes one (query block x reference block) pair of
+    'knn_sharded' in a worker process."""
+    q_start, q_end, r_start, r_end, k, metric, self_search = task
+    arrays = SHARD_ARRAYS[1]
+    X = arrays[0]
+    Y, sq_norms = (X, arrays[1]) if self_search else arrays[1:]
+    return knn_shard(X[q_start:q_end], Y[r_start:r_end],
+                     sq_norms[r_start:r_end], q_start, r_start, k, metric,
+                     self_search)
+
+
+def knn_sharded(X, k, metric='correlation', Y=None, block_size=4096,
+                n_jobs=None):
+    """Exact k-nearest neighbors computed over shards in a pool of worker
+    processes.
+
+    The rows are split into blocks of 'block_size' and every (query block x
+    reference block) pair is processed by a worker process, which maps the
+    data from shared memory instead of receiving a copy. The partial top-k
+    lists of each query block are reduced with argpartition as they arrive,
+    so only (cells x k) neighbors and one distance tile per worker are held
+    in memory. The result matches 'knn_blocked': each cell is its own
+    nearest neighbor and neighbors are sorted by distance.
+
+    Parameters
+    ----------
+    X - numpy.ndarray
+        The (cells x features) data.
+
+    k - int
+        The number of nearest neighbors (including the cell itself).
+
+    metric - str, optional, default 'correlation'
+        'correlation', 'cosine', or 'euclidean'.
+
+    Y - numpy.ndarray, optional, default None
+        If provided, the neighbors of the rows of 'X' are searched among the
+        rows of 'Y' (which need not include the cells themselves).
+
+    block_size - int, optional, default 4096
+        The number of rows per block.
+
+    n_jobs - int, optional, default None
+        The number of worker processes. If None, uses one per core. If 1,
+        the blocks are processed in the calling process.
+
+    Returns
+    -------
+    (knn_indices, knn_dists), each (cells x k) and sorted by distance.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if metric not in ('correlation', 'cosine', 'euclidean'):
+        raise ValueError("'knn_sharded' supports the correlation, cosine, "
+                         "and euclidean metrics.")
+
+    self_search = Y is None
+    X = prepare_knn_data(X, metric)
+    Y = X if self_search else prepare_knn_data(Y, metric)
+    n = X.shape[0]
+    m = Y.shape[0]
+    k = min(k, m)
+    sq_norms = (Y**2).sum(1)
+
+    tasks = [(qs, min(n, qs + block_size), rs, min(m, rs + block_size), k,
+              metric, self_search)
+             for qs in range(0, n, block_size) for rs in range(0, m, block_size)]
+
+    # running top-k of each query block
+    best_idx = [np.zeros((min(n, qs + block_size) - qs, 0), dtype='int64')
+                for qs in range(0, n, block_size)]
+    best_dist = [np.zeros((min(n, qs + block_size) - qs, 0), dtype=X.dtype)
+                 for qs in range(0, n, block_size)]
+
+    def reduce(task, result):
+        b = task[0] // block_size
+        idx = np.hstack((best_idx[b], result[0]))
+        dist = np.hstack((best_dist[b], result[1]))
+        if idx.shape[1] > k:
+            rows = np.arange(idx.shape[0])[:, None]
+            sel = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            idx, dist = idx[rows, sel], dist[rows, sel]
+        best_idx[b], best_dist[b] = idx, dist
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(tasks)))
+    if n_jobs == 1:
+        for task in tasks:
+            qs, qe, rs, re_ = task[:4]
+            reduce(task, knn_shard(X[qs:qe], Y[rs:re_], sq_norms[rs:re_],
+                                   qs, rs, k, metric, self_search))
     else:
-        if sp.sparse.issparse(g_weighted):
-            g_weighted=g_weighted.A
-        dist = compute_distances(g_weighted, distance)
-        nnm = dist_to_nn(dist, k)
-        EDM = sp.sparse.csr_matrix(nnm)
-    return EDM
+        blocks, specs = share_arrays([X, sq_norms] if self_search else
+                                     [X, Y, sq_norms])
+        try:
+            n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+            with ProcessPoolExecutor(
+                    max_workers=n_jobs,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=knn_shard_init,
+                    initargs=(specs, n_threads)) as pool:
+                results = pool.map(knn_shard_worker, tasks, chunksize=max(
+                    1, len(tasks) // (8 * n_jobs)))
+                for task, result in zip(tasks, results):
+                    reduce(task, result)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    knn_indices = np.vstack(best_idx)
+    knn_dists = np.vstack(best_dist)
+    rows = np.arange(n)[:, None]
+    order = np.argsort(knn_dists, axis=1)
+    knn_indices = knn_indices[rows, order]
+    knn_dists = knn_dists[rows, order]
+    if self_search:
+        knn_dists[:, 0] = 0
+    if metric == 'euclidean':
+        knn_dists = np.sqrt(knn_dists)
+    elif not self_search:
+        knn_dists[knn_dists < 0] = 0
+    return knn_indices, knn_dists
+
+
+class NNDescentKNN(object):
+    """NN-descent kNN backend: a random projection forest and an NN-descent
+    neighbor graph built with pynndescent."""
+
+    def __init__(self, X, metric='correlation', n_neighbors=15, seed=0):
+        from pynndescent import NNDescent
+        self.index = NNDescent(X, metric=metric, n_neighbors=n_neighbors,
+                               random_state=seed)
+
+    def neighbor_graph(self):
+        return self.index.neighbor_graph
+
+    def query(self, X, k):
+        return self.index.query(X, k=k)
+
+
+class HNSWKNN(object):
+    """HNSW kNN backend: a hierarchical navigable small world graph built
+    with hnswlib. Supports the correlation, cosine, and euclidean metrics
+    (correlation is computed as the cosine distance of the centered
+    rows)."""
+
+    def __init__(self, X, metric='correlation', n_neighbors=15, seed=0,
+                 M=16, ef_construction=400):
+        import hnswlib
+        if metric not in ('correlation', 'cosine', 'euclidean'):
+            raise ValueError("The 'hnsw' kNN method supports the "
+                             "correlation, cosine, and euclidean metrics.")
+        self.metric = metric
+        X = self.prepare(X)
+        self.index = hnswlib.Index(
+            space='l2' if metric == 'euclidean' else 'cosine', dim=X.shape[1])
+        self.index.init_index(max_elements=X.shape[0], M=M,
+                              ef_construction=ef_construction,
+                              random_seed=seed)
+        self.index.add_items(X, np.arange(X.shape[0]))
+
+    def prepare(self, X):
+        return prepare_knn_data(X, self.metric, dtype='float32')
+
+    def query(self, X, k):
+        self.index.set_ef(max(4 * k, 200))
+        knn_indices, knn_dists = self.index.knn_query(self.prepare(X), k=k)
+        if self.metric == 'euclidean':
+            # hnswlib returns squared euclidean distances
+            knn_dists = np.sqrt(np.maximum(knn_dists, 0))
+        return knn_indices.astype('int64'), knn_dists
+
+
+# Approximate kNN backends selectable by name in 'NNIndex', 'knn_search',
+# and SAM.run(knn_method=...). A backend is a class constructed with
+# (X, metric, n_neighbors, seed) that implements query(X, k) and,
+# optionally, neighbor_graph(). The exact searches, 'exact' (knn_blocked)
+# and 'sharded' (knn_sharded), are always available and are not listed
+# here.
+KNN_METHODS = {'nndescent': NNDescentKNN, 'hnsw': HNSWKNN}
+EXACT_KNN_METHODS = ('exact', 'sharded')
+
+
+def knn_method_available(method):
+    """Returns True if the kNN backend 'method' can be used, i.e. if its
+    optional dependency is installed."""
+    module = {'nndescent': 'pynndescent', 'hnsw': 'hnswlib'}.get(method)
+    if method in EXACT_KNN_METHODS or (module is None and
+                                       method in KNN_METHODS):
+        return True
+    if module is None:
+        return False
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def choose_knn_method(n, d, exact_budget=2e10, hnsw_cutoff=500000):
+    """Picks a kNN backend for 'n' points with 'd' features.
+
+    Exact search is used while the all-pairs distance computation
+    (about n^2 * d operations) fits within 'exact_budget', e.g. up to about
+    11500 cells in 150 PCs, beyond which NN-descent is faster. Larger
+    datasets use NN-descent, or an HNSW index above 'hnsw_cutoff' points,
+    falling back to whichever of the two is installed. If neither is, an
+    ImportError is raised rather than silently running a brute-force
+    search beyond 'exact_budget' ('exact' or 'sharded' can still be
+    requested explicitly).
+    """
+    if float(n)**2 * d <= exact_budget:
+        return 'exact'
+    order = ('hnsw', 'nndescent') if n > hnsw_cutoff else ('nndescent',
+                                                          'hnsw')
+    for method in order:
+        if knn_method_available(method):
+            return method
+    raise ImportError(
+        "Neither pynndescent nor hnswlib is installed for the approximate "
+        "kNN search of {} points. Install one of them, or choose "
+        "knn_method='exact' or 'sharded' for a brute-force search.".format(n))
+
+
+class NNIndex(object):
+    """A nearest-neighbor index of the rows of 'X' (e.g. the final PCs of a
+    SAM run) that can be queried with new points and pickled or saved with
+    a SAM project.
+
+    'method' selects the backend: 'exact' searches the stored rows with
+    'knn_blocked', 'sharded' with 'knn_sharded' (in a pool of worker
+    processes), 'nndescent' builds a random projection forest and an
+    NN-descent graph (pynndescent), and 'hnsw' builds an HNSW graph
+    (hnswlib). Other backends can be added to KNN_METHODS. If 'auto', the
+    backend is chosen with 'choose_knn_method'.
+    """
+
+    def __init__(self, X, metric='correlation', n_neighbors=15,
+                 method='auto', seed=0):
+        if sp.sparse.issparse(X):
+            X = X.toarray()
+        self.data = np.asarray(X)
+        self.metric = metric
+        self.n_neighbors = n_neighbors
+        self.graph_indices = None
+        self.graph_dists = None
+        self.index = None
+
+        if method == 'auto':
+            method = choose_knn_method(*self.data.shape)
+        if method not in EXACT_KNN_METHODS:
+            if method not in KNN_METHODS:
+                raise ValueError("Unknown kNN method '{}'. Choose one of "
+                                 "{}.".format(method, list(
+                                     EXACT_KNN_METHODS) + list(KNN_METHODS)))
+            self.index = KNN_METHODS[method](self.data, metric=metric,
+                                             n_neighbors=n_neighbors,
+                                             seed=seed)
+        self.method = method
+
+    def neighbor_graph(self):
+        """Returns the (knn_indices, knn_dists) of the indexed rows among
+        themselves, each listed as its own first neighbor."""
+        if self.graph_indices is None:
+            if self.method == 'sharded':
+                knni, knnd = knn_sharded(self.data, self.n_neighbors,
+                                         metric=self.metric)
+            elif self.index is None:
+                knni, knnd = knn_blocked(self.data, self.n_neighbors,
+                                         metric=self.metric)
+            elif hasattr(self.index, 'neighbor_graph'):
+                knni, knnd = self.index.neighbor_graph()
+            else:
+                knni, knnd = self.query(self.data, k=self.n_neighbors)
+                # approximate searches can miss or misplace the row itself
+                rows = np.arange(knni.shape[0])
+                is_self = knni == rows[:, None]
+                missing = ~is_self.any(1)
+                knni[missing, -1] = rows[missing]
+                is_self[missing, -1] = True
+                order = np.argsort(~is_self, axis=1, kind='stable')
+                knni = np.take_along_axis(knni, order, 1)
+                knnd = np.take_along_axis(knnd, order, 1)
+                knnd[:, 0] = 0
+            self.graph_indices, self.graph_dists = knni, knnd
+        return self.graph_indices, self.graph_dists
+
+    def query(self, X, k=None, batch_size=20000):
+        """Finds the k nearest indexed rows of each row of 'X', querying
+        'batch_size' rows at a time.
+
+        Returns
+        -------
+        (knn_indices, knn_dists), each (rows of X x k).
+        """
+        if k is None:
+            k = self.n_neighbors
+        if sp.sparse.issparse(X):
+            X = X.toarray()
+        n = X.shape[0]
+        knn_indices = np.zeros((n, k), dtype='int64')
+        knn_dists = np.zeros((n, k), dtype='float32')
+        for start in range(0, n, batch_size):
+            end = min(n, start + batch_size)
+            if self.index is not None:
+                idx, dd = self.index.query(X[start:end], k)
+            elif self.method == 'sharded':
+                idx, dd = knn_sharded(X[start:end], k, metric=self.metric,
+                                      Y=self.data)
+            else:
+                idx, dd = knn_blocked(X[start:end], k, metric=self.metric,
+                                      Y=self.data)
+            knn_indices[start:end] = idx
+            knn_dists[start:end] = dd
+        return knn_indices, knn_dists
+
+
+def knn_query(Y, X, k, metric='correlation', method='auto'):
+    """Finds the k nearest neighbors of the rows of 'X' among the rows of the
+    reference 'Y' with the kNN backend 'method' (see 'NNIndex').
+
+    Returns
+    -------
+    (knn_indices, knn_dists), each (rows of X x k) with indices into 'Y'.
+    """
+    return NNIndex(Y, metric=metric, n_neighbors=max(k, 15),
+                   method=method).query(X, k=k)
+
+
+def geometric_sketch(X, n, seed=0, n_iter=20):
+    """Selects 'n' cells that evenly cover the space spanned by the rows of
+    'X' (e.g. principal components), following the geometric sketching
+    approach of Hie et al. (2019).
+
+    The space is covered by a grid of equally-sized hypercubes whose side
+    length is chosen by bisection so that at least 'n' boxes are occupied.
+    'n' occupied boxes are then chosen uniformly at random and one cell is
+    sampled from each, so rare cell states are kept regardless of their
+    abundance. Returns the sorted indices of the selected cells.
+    """
+    rng = np.random.RandomState(seed)
+    N = X.shape[0]
+    if n >= N:
+        return np.arange(N)
+
+    X = X - X.min(0)
+    X = X / max(X.max(), np.finfo(float).tiny)
+    hashes = rng.randint(1, 2**62, size=X.shape[1]).astype('uint64')
+
+    def boxes(side):
+        codes = np.floor(X / side).astype('uint64')
+        return np.unique(codes.dot(hashes), return_inverse=True)[1]
+
+    low, high = 0., 1.
+    side = None
+    for i in range(n_iter):
+        mid = (low + high) / 2
+        inverse = boxes(mid)
+        if inverse.max() + 1 >= n:
+            low = mid
+            side = mid
+        else:
+            high = mid
+    if side is None:
+        return np.sort(rng.choice(N, n, replace=False))
+
+    inverse = boxes(side)
+    order = rng.permutation(N)
+    # one random cell per occupied box, then a random subset of the boxes
+    first = np.unique(inverse[order], return_index=True)[1]
+    cells = order[first]
+    return np.sort(rng.choice(cells, n, replace=False))
+
+
+def density_sketch(X, n, k=15, seed=0, metric='euclidean', n_ref=10000):
+    """Selects 'n' cells with probabilities proportional to the distance to
+    their k-th nearest neighbor, oversampling sparse regions of the space
+    relative to dense ones. Returns the sorted indices of the selected
+    cells.
+
+    The neighbors are searched among a random sample of 'n_ref' rows of 'X',
+    so the cost grows linearly with the number of cells. The distances to
+    the sample are proportional to those to all cells for any local
+    density, so the relative sampling probabilities are preserved."""
+    rng = np.random.RandomState(seed)
+    N = X.shape[0]
+    if n >= N:
+        return np.arange(N)
+    ref = np.sort(rng.choice(N, min(n_ref, N), replace=False))
+    knnd = knn_query(X[ref], X, k + 1, metric=metric)[1]
+    # cells in the sample are their own nearest neighbor
+    in_ref = np.zeros(N, dtype='bool')
+    in_ref[ref] = True
+    dists = np.where(in_ref, knnd[:, k], knnd[:, k - 1]).astype('float64')
+    if dists.sum() == 0:
+        dists[:] = 1
+    return np.sort(rng.choice(N, n, replace=False, p=dists / dists.sum()))
+
 
 def compute_distances(A, dm):
     if(dm == 'euclidean'):
@@ -375,31 +2031,217 @@ def to_sparse_knn(D1, k):
     return D1
 """
 def to_sparse_knn(D1,k):
-    for i in range(D1.shape[0]):
-        x = D1.data[D1.indptr[i]:D1.indptr[i+1]]
-        idx = np.argsort(x)
-        if idx.size > k:
-            x[idx[:-k]]=0
-        D1.data[D1.indptr[i]:D1.indptr[i+1]] = x
-    D1.eliminate_zeros()
-    return D1
-def gen_sparse_knn(knni, knnd, shape = None):
+    """Keeps the k largest entries (e.g. affinities) of each row of the
+    sparse matrix 'D1'."""
+    return sparse_topk(D1, k, largest=True)
+
+
+@numba.njit(parallel=True, cache=True)
+def topk_kernel(indptr, data, k, largest, n_chunks):
+    """Marks the (up to) k largest or smallest nonzero entries of each row
+    of a CSR matrix and counts them per row."""
+    n = indptr.size - 1
+    keep = np.zeros(data.size, dtype=np.bool_)
+    counts = np.zeros(n, dtype=np.int64)
+    sign = -1.0 if largest else 1.0
+    chunk = (n + n_chunks - 1) // n_chunks
+    for c in numba.prange(n_chunks):
+        # the k smallest (signed) values seen so far, in ascending order
+        best = np.empty(k, dtype=np.float64)
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            s = indptr[i]
+            e = indptr[i + 1]
+            if e - s > k:
+                m = 0
+                for j in range(s, e):
+                    v = sign * data[j]
+                    if m < k or v < best[m - 1]:
+                        p = m if m < k else k - 1
+                        while p > 0 and best[p - 1] > v:
+                            best[p] = best[p - 1]
+                            p -= 1
+                        best[p] = v
+                        if m < k:
+                            m += 1
+                thr = best[k - 1]
+                # ties with the k-th value are kept in column order
+                ties = 0
+                for p in range(k):
+                    if best[p] == thr:
+                        ties += 1
+                for j in range(s, e):
+                    v = sign * data[j]
+                    if v < thr or (v == thr and ties > 0):
+                        if v == thr:
+                            ties -= 1
+                        keep[j] = data[j] != 0
+            else:
+                for j in range(s, e):
+                    keep[j] = data[j] != 0
+            cnt = 0
+            for j in range(s, e):
+                if keep[j]:
+                    cnt += 1
+            counts[i] = cnt
+    return keep, counts
+
+
+@numba.njit(parallel=True, cache=True)
+def compact_kernel(indptr, indices, data, keep, new_indptr):
+    """Copies the kept entries of a CSR matrix into new arrays."""
+    n = indptr.size - 1
+    new_indices = np.empty(new_indptr[n], dtype=indices.dtype)
+    new_data = np.empty(new_indptr[n], dtype=data.dtype)
+    for i in numba.prange(n):
+        p = new_indptr[i]
+        for j in range(indptr[i], indptr[i + 1]):
+            if keep[j]:
+                new_indices[p] = indices[j]
+                new_data[p] = data[j]
+                p += 1
+    return new_indices, new_data
+
+
+def sparse_topk(X, k, largest=False):
+    """Keeps the k smallest (e.g. distances) or, if 'largest', the k largest
+    (e.g. affinities) nonzero entries of each row of the sparse matrix 'X'.
+    Explicit zeros are dropped. If no row has more than k nonzero entries,
+    'X' is returned without copying."""
+    X = sp.sparse.csr_matrix(X)
+    keep, counts = topk_kernel(X.indptr, X.data, k, largest,
+                               max(1, min(X.shape[0], 1024)))
+    if counts.sum() == X.nnz:
+        return X
+    new_indptr = np.zeros(X.shape[0] + 1, dtype=X.indptr.dtype)
+    np.cumsum(counts, out=new_indptr[1:])
+    new_indices, new_data = compact_kernel(X.indptr, X.indices, X.data,
+                                           keep, new_indptr)
+    return sp.sparse.csr_matrix((new_data, new_indices, new_indptr),
+                                shape=X.shape)
+
+
+@numba.njit(parallel=True, cache=True)
+def csr_knn_kernel(indptr, indices, data, k, sort):
+    """Gathers the (up to) k first or, if 'sort', k smallest entries of
+    each row of a CSR matrix into padded (rows x k) arrays."""
+    n = indptr.size - 1
+    knni = np.full((n, k), -1, dtype=np.int64)
+    knnd = np.full((n, k), np.inf, dtype=data.dtype)
+    for i in numba.prange(n):
+        s = indptr[i]
+        e = indptr[i + 1]
+        if sort:
+            order = np.argsort(data[s:e], kind='mergesort')
+        else:
+            order = np.arange(e - s)
+        for j in range(min(k, e - s)):
+            knni[i, j] = indices[s + order[j]]
+            knnd[i, j] = data[s + order[j]]
+    return knni, knnd
+
+
+@numba.njit(parallel=True, cache=True)
+def sort_knn_kernel(knni, knnd):
+    for i in numba.prange(knni.shape[0]):
+        order = np.argsort(knnd[i], kind='mergesort')
+        knni[i] = knni[i][order]
+        knnd[i] = knnd[i][order]
+
+
+def sort_knn(knni, knnd):
+    """Sorts the neighbors in each row of the (cells x k) index and distance
+    arrays by distance, in place. Returns (knni, knnd)."""
+    sort_knn_kernel(knni, knnd)
+    return knni, knnd
+
+
+def csr_to_knn(nnm, k=None, sort=True):
+    """Converts a sparse nearest-neighbor graph, whose values are distances,
+    to (cells x k) index and distance arrays.
+
+    If 'sort', the neighbors of each row are sorted by distance (keeping
+    the k nearest). Rows with fewer than k neighbors are padded with index
+    -1 and distance inf. If every row stores exactly k neighbors and
+    'sort' is False, the arrays are views of the matrix's own arrays.
+    """
+    nnm = sp.sparse.csr_matrix(nnm)
+    counts = np.diff(nnm.indptr)
+    if k is None:
+        k = int(counts.max()) if counts.size > 0 else 0
+    data = nnm.data
+    if data.dtype.kind not in 'f':
+        data = data.astype('float64')
+    if not sort and np.all(counts == k):
+        return (nnm.indices.reshape((nnm.shape[0], k)),
+                data.reshape((nnm.shape[0], k)))
+    return csr_knn_kernel(nnm.indptr, nnm.indices, data, k, sort)
+
+
+def symmetrize_knn(nnm, how='max'):
+    """Symmetrizes a sparse nearest-neighbor graph. 'how' is 'max' (the
+    element-wise maximum of the graph and its transpose), 'min', 'mean', or
+    'fuzzy' (the fuzzy set union A + A^T - A * A^T used by UMAP)."""
+    nnm = sp.sparse.csr_matrix(nnm)
+    nnmT = nnm.T.tocsr()
+    if how == 'max':
+        return nnm.maximum(nnmT).tocsr()
+    if how == 'min':
+        return nnm.minimum(nnmT).tocsr()
+    if how == 'mean':
+        return ((nnm + nnmT) / 2).tocsr()
+    if how == 'fuzzy':
+        return (nnm + nnmT - nnm.multiply(nnmT)).tocsr()
+    raise ValueError("'how' must be 'max', 'min', 'mean', or 'fuzzy'.")
+
+def gen_sparse_knn(knni, knnd=None, shape=None, symmetrize=False):
+    """Builds a CSR nearest-neighbor graph directly from (cells x k) neighbor
+    index and distance arrays.
+
+    Parameters
+    ----------
+    knni - numpy.ndarray, int
+        The (cells x k) nearest-neighbor indices.
+
+    knnd - numpy.ndarray, optional, default None
+        The (cells x k) edge values (e.g. distances). Zero-valued edges are
+        dropped. If None, a binary adjacency matrix is returned and
+        duplicate neighbors are merged.
+
+    shape - tuple, optional, default None
+        The shape of the output graph. If None, it is (cells x cells).
+
+    symmetrize - bool, optional, default False
+        If True, returns the element-wise maximum of the graph and its
+        transpose.
+    """
+    knni = np.asarray(knni)
+    n, k = knni.shape
     if shape is None:
-        shape = (knni.shape[0],knni.shape[0])
+        shape = (n, n)
 
-    D1 = sp.sparse.lil_matrix(shape)
+    if knnd is None:
+        data = np.ones(n * k)
+    else:
+        data = np.asarray(knnd).reshape(-1)
+
+    D1 = sp.sparse.csr_matrix((data, knni.reshape(-1),
+                               np.arange(0, n * k + 1, k)), shape=shape)
+    D1.sum_duplicates()
+    if knnd is None:
+        D1.data[:] = 1
+    else:
+        D1.eliminate_zeros()
 
-    D1[np.tile(np.arange(knni.shape[0])[:,None],(1,knni.shape[1])).flatten(),
-       knni.flatten()] = knnd.flatten()
-    D1=D1.tocsr()
+    if symmetrize:
+        D1 = symmetrize_knn(D1, how='max')
     return D1
 
 def get_knn_ind_dist(nnm,dist):
-    x,y = nnm.nonzero();
-    k = int(nnm[0,:].sum())
-    knnd = dist[x,y].reshape((nnm.shape[0],k))
-    knni = y.reshape((nnm.shape[0],k))
-    i = np.argsort(knnd,axis=1)
-    knni = knni[x,i.flatten()].reshape(knni.shape)
-    knnd = knnd[x,i.flatten()].reshape(knnd.shape)
-    return knni,knnd
+    """Returns the (cells x k) indices and distances of the neighbors in the
+    nearest-neighbor graph 'nnm', sorted by distance, where 'dist' is the
+    dense (cells x cells) distance matrix."""
+    nnm = sp.sparse.csr_matrix(nnm)
+    rows = np.repeat(np.arange(nnm.shape[0]), np.diff(nnm.indptr))
+    d = sp.sparse.csr_matrix((np.asarray(dist)[rows, nnm.indices],
+                              nnm.indices, nnm.indptr), shape=nnm.shape)
+    return csr_to_knn(d)